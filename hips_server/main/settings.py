@@ -10,6 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+
+from corsheaders.defaults import default_headers
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -20,16 +23,35 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 'django-insecure-p2konlmi33ir0_yfh4ptr6912civ3u7#@0i-*p(_l*hrx&p24v'
+SECRET_KEY = os.environ.get(
+    'DJANGO_SECRET_KEY',
+    'django-insecure-p2konlmi33ir0_yfh4ptr6912civ3u7#@0i-*p(_l*hrx&p24v',
+)
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.environ.get('DJANGO_DEBUG', 'true').lower() in ('1', 'true', 'yes')
 
-ALLOWED_HOSTS = []
+# Comma-separated, e.g. "localhost,hips.example.org"
+ALLOWED_HOSTS = [host for host in os.environ.get('DJANGO_ALLOWED_HOSTS', '').split(',') if host]
 
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
 ]
+# Revalidation of cached responses, see tcga/response_cache.py
+CORS_ALLOW_HEADERS = (*default_headers, 'if-none-match')
+CORS_EXPOSE_HEADERS = ['ETag']
+
+# Bytes of serialized responses kept in memory by each server process, and on disk
+RESPONSE_CACHE_MEMORY_BYTES = int(os.environ.get('RESPONSE_CACHE_MEMORY_BYTES', str(64 << 20)))
+RESPONSE_CACHE_DISK_BYTES = int(os.environ.get('RESPONSE_CACHE_DISK_BYTES', str(1 << 30)))
+
+# Addresses or networks allowed to read /metrics, comma-separated
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+# When set, requests slower than this many milliseconds write a sampled profile to data/profiles
+PROFILE_SLOW_REQUESTS_MS = (
+    float(os.environ['PROFILE_SLOW_REQUESTS_MS']) if os.environ.get('PROFILE_SLOW_REQUESTS_MS') else None
+)
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
 
 # Application definition
 
@@ -44,6 +66,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so that it times the other middleware too
+    'tcga.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -72,17 +96,48 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'main.wsgi.application'
+# The API is served by an ASGI server (uvicorn), see README.md
+ASGI_APPLICATION = 'main.asgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default. Write-ahead logging lets server processes keep reading while another
+# process (such as populate) writes, and writers wait up to `timeout` seconds for a lock
+# instead of failing. Set DJANGO_DATABASE=postgres to use PostgreSQL instead.
+
+if os.environ.get('DJANGO_DATABASE', 'sqlite') == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'hips'),
+            'USER': os.environ.get('POSTGRES_USER', 'hips'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Connections are kept in a pool per server process;
+            # persistent connections (CONN_MAX_AGE) do not work with async views
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', '2')),
+                    'max_size': int(os.environ.get('POSTGRES_POOL_MAX_SIZE', '10')),
+                },
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                'timeout': int(os.environ.get('SQLITE_TIMEOUT', '20')),
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -17,8 +17,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from tcga.api import api
+from tcga.metrics import metrics_view
 
 urlpatterns = [
     path('api/', api.urls),
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view),
 ]
@@ -1,8 +1,10 @@
 from django.contrib import admin
 
-from .models import Image, Cell, UMAPTransform, UMAPResult
+from .models import Image, Cell, ROIManifest, ColumnStats, UMAPTransform, UMAPResult
 
 admin.site.register(Image)
 admin.site.register(Cell)
+admin.site.register(ROIManifest)
+admin.site.register(ColumnStats)
 admin.site.register(UMAPTransform)
 admin.site.register(UMAPResult)
@@ -1,14 +1,45 @@
-import json
-
-from ninja import NinjaAPI, ModelSchema
-from ninja.pagination import paginate
-from typing import List
-from .models import Image, Cell, UMAPTransform, UMAPResult
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404, aget_object_or_404
+from ninja import NinjaAPI, ModelSchema, Schema, Field, Query
+from ninja.conf import settings
+from ninja.decorators import decorate_view
+from ninja.errors import HttpError
+from ninja.pagination import paginate, AsyncPaginationBase
+from ninja.renderers import JSONRenderer
+from typing import Any, Dict, List, Literal, Optional
+from .models import Image, Cell, ColumnStats, UMAPTransform, UMAPResult
 
 from tcga.constants import VECTOR_COLUMNS
+from tcga.feature_store import FeatureStore
+from tcga.binary import (
+    CONTENT_TYPE, pack_image_cells, pack_viewport, pack_result_points, pack_result_tile,
+)
+from tcga.histogram import DEFAULT_BUCKETS, compute_histogram
+from tcga.attributes import CellAttributes
+from tcga.spatial_index import MissingIndexError
+from tcga.id_runs import encode_id_runs, decode_id_runs, IdRunSet
+from tcga.column_stats import update_column_stats
+from tcga.similarity import DEFAULT_NEIGHBORS, MAX_NEIGHBORS, find_similar_cells
+from tcga.response_cache import cache_response
+from tcga.metrics import timed
+
+
+class TimedJSONRenderer(JSONRenderer):
+    # Reports the time spent serializing responses to the metrics middleware
+    def render(self, request, data, *, response_status):
+        with timed('render'):
+            return super().render(request, data, response_status=response_status)
+
+
+api = NinjaAPI(renderer=TimedJSONRenderer())
 
 
-api = NinjaAPI()
+@api.exception_handler(MissingIndexError)
+def missing_index(request, exc):
+    # Answered until populate has built the index of the image
+    return api.create_response(request, {'detail': exc.args[0]}, status=503)
 
 
 class ImageSchema(ModelSchema):
@@ -17,10 +48,83 @@ class ImageSchema(ModelSchema):
         model_fields = ['id', 'name', 'tile_url']
 
 
+CELL_FIELDS = ['id', 'x', 'y', 'width', 'height', 'orientation', 'classification']
+
+
 class CellSchema(ModelSchema):
+    vector: List[Any] = []
+
     class Config:
         model = Cell
-        model_fields = ['id', 'x', 'y', 'width', 'height', 'orientation', 'classification', 'vector']
+        model_fields = CELL_FIELDS
+        # Fields left out with the fields parameter are omitted from the response
+        model_fields_optional = CELL_FIELDS[1:]
+
+
+def parse_names(value, allowed, parameter):
+    # Comma-separated names, checked against the allowed names
+    if value is None:
+        return allowed
+    names = [name for name in value.split(',') if name]
+    unknown = [name for name in names if name not in allowed]
+    if len(unknown):
+        raise HttpError(400, f'Unknown {parameter}: {", ".join(unknown)}')
+    return names
+
+
+class CellKeysetPagination(AsyncPaginationBase):
+    """
+    Pages through cells in id order with a cursor (id > after) instead of an offset,
+    so that every page costs the same. Vectors are attached for a whole page at once
+    from the image FeatureStore, projected to the requested columns.
+    """
+
+    class Input(Schema):
+        after: Optional[int] = Field(None, ge=0)
+        limit: int = Field(settings.PAGINATION_PER_PAGE, ge=1)
+
+    class Output(Schema):
+        items: List[Any]
+        # Only counted on the first page
+        count: Optional[int] = None
+        # Cursor for the next page, null on the last page
+        next: Optional[int] = None
+
+    def paginate_queryset(self, queryset, pagination, fields=None, columns=None, **params):
+        limit = min(pagination.limit, settings.PAGINATION_MAX_LIMIT)
+        fields = parse_names(fields, CELL_FIELDS[1:], 'fields')
+        columns = parse_names(columns, VECTOR_COLUMNS, 'columns')
+        count = queryset.count() if pagination.after is None else None
+        if pagination.after is not None:
+            queryset = queryset.filter(id__gt=pagination.after)
+        items = list(queryset[:limit].values('id', *fields, 'image_id'))
+        for image_id in {item['image_id'] for item in items}:
+            image_items = [item for item in items if item['image_id'] == image_id]
+            store = FeatureStore(image_id)
+            if not store.exists() or not len(columns):
+                continue
+            rows = store.rows_for_ids([item['id'] for item in image_items])
+            for item, vector in zip(image_items, store.vectors(rows, columns)):
+                item['vector'] = vector
+        for item in items:
+            del item['image_id']
+        return dict(
+            items=items,
+            count=count,
+            next=items[-1]['id'] if len(items) == limit else None,
+        )
+
+    async def apaginate_queryset(self, queryset, pagination, **params):
+        return await sync_to_async(self.paginate_queryset)(queryset, pagination, **params)
+
+
+class ColumnStatsSchema(ModelSchema):
+    class Config:
+        model = ColumnStats
+        model_fields = [
+            'name', 'kind', 'count', 'null_count', 'minimum', 'maximum',
+            'mean', 'std', 'quantiles', 'categories',
+        ]
 
 
 class UMAPTransformSchema(ModelSchema):
@@ -32,46 +136,238 @@ class UMAPTransformSchema(ModelSchema):
 class UMAPResultSchema(ModelSchema):
     class Config:
         model = UMAPResult
-        model_fields = ['id', 'created', 'transform', 'scatterplot_data']
+        model_fields = ['id', 'created', 'transform', 'cell_count']
+
+
+class SimilarCell(Schema):
+    id: int
+    image: Optional[int] = None
+    distance: float
+
+
+class SimilarCellsQuery(Schema):
+    cell_id: int
+    k: int = Field(DEFAULT_NEIGHBORS, ge=1, le=MAX_NEIGHBORS)
+
+
+class SimilarCellsRequest(Schema):
+    # One value per numeric column of the transform, in column order
+    vector: List[Optional[float]]
+    k: int = Field(DEFAULT_NEIGHBORS, ge=1, le=MAX_NEIGHBORS)
+
+
+class HistogramQuery(Schema):
+    attribute: str
+    buckets: int = Field(DEFAULT_BUCKETS, ge=1, le=1000)
+    # Bucket spacing for numeric attributes
+    scale: Literal['linear', 'log'] = 'linear'
+    # Include the ids of each bucket as [first, last] runs
+    bucket_ids: bool = False
+
+
+class IdRuns(Schema):
+    # Run-length encoded cell ids, see tcga.id_runs
+    base: int
+    runs: List[int]
+    count: Optional[int] = None
+
+
+class CellSubset(Schema):
+    # Restrict to these cells, given as a list of ids or as id runs
+    cell_ids: Optional[List[int]] = None
+    selection: Optional[IdRuns] = None
+    # Attribute name to a [min, max] range or a list of accepted values
+    filters: Dict[str, List[Any]] = {}
+
+    def get_cell_ids(self):
+        if self.selection is not None:
+            return decode_id_runs(self.selection.base, self.selection.runs)
+        return self.cell_ids
+
 
-    @staticmethod
-    def resolve_scatterplot_data(obj):
-        return json.loads(obj.scatterplot_data)
+class HistogramRequest(HistogramQuery, CellSubset):
+    pass
+
+
+def histogram_response(image_id, query, cell_ids=None, filters=None):
+    try:
+        return compute_histogram(
+            image_id, query.attribute, query.buckets, query.scale,
+            cell_ids, filters, query.bucket_ids,
+        )
+    except (KeyError, ValueError) as e:
+        raise HttpError(400, e.args[0])
+
+
+def streaming_packed_response(request, packed):
+    # Under ASGI the payload is streamed by async iteration, so that it is not buffered first
+    content = aiter(packed) if isinstance(request, ASGIRequest) else iter(packed)
+    response = StreamingHttpResponse(content, content_type=CONTENT_TYPE)
+    response['Content-Length'] = len(packed)
+    return response
 
 
 @api.get('/images', response=List[ImageSchema])
+@decorate_view(cache_response('images'))
 def images(request):
     return Image.objects.all()
 
 
-@api.get('/images/{image_id}/cells', response=List[CellSchema])
-@paginate()
-def cells(request, image_id):
-    return Cell.objects.filter(image__id=image_id)
+@api.get('/images/{image_id}/cells', response=List[CellSchema], exclude_unset=True)
+@decorate_view(cache_response('image:{image_id}'))
+@paginate(CellKeysetPagination)
+async def cells(request, image_id, fields: str = None, columns: str = None):
+    # fields: comma-separated Cell fields besides id; columns: comma-separated VECTOR_COLUMNS
+    return Cell.objects.filter(image__id=image_id).order_by('id')
+
+
+@api.get('/images/{image_id}/cells/binary')
+@decorate_view(cache_response('image:{image_id}', store=False))
+async def cells_binary(request, image_id):
+    # All cells of the image in one streamed response, in the packed format of tcga.binary
+    packed = await sync_to_async(pack_image_cells)(image_id)
+    return streaming_packed_response(request, packed)
+
+
+@api.get('/images/{image_id}/cells/viewport')
+@decorate_view(cache_response('image:{image_id}', store=False))
+async def cells_viewport(request, image_id: int, bbox: str, zoom: float, max_zoom: float):
+    # bbox: left,top,right,bottom in image pixels; zoom and max_zoom are geojs zoom levels
+    try:
+        left, top, right, bottom = [float(v) for v in bbox.split(',')]
+    except ValueError:
+        raise HttpError(400, 'bbox must be four comma-separated numbers: left,top,right,bottom')
+    packed = await sync_to_async(pack_viewport)(image_id, (left, top, right, bottom), zoom, max_zoom)
+    return streaming_packed_response(request, packed)
+
+
+@api.get('/images/{image_id}/histogram')
+@decorate_view(cache_response('image:{image_id}'))
+def histogram(request, image_id: int, query: Query[HistogramQuery]):
+    return histogram_response(image_id, query)
+
+
+@api.post('/images/{image_id}/histogram')
+def histogram_subset(request, image_id: int, query: HistogramRequest):
+    # POST for histograms of a subset of cells, which may be too many ids for a query string
+    return histogram_response(image_id, query, query.get_cell_ids(), query.filters)
+
+
+@api.post('/images/{image_id}/filter', response=IdRuns)
+def filter_cells(request, image_id: int, query: CellSubset):
+    # Ids of the cells that match every filter, run-length encoded
+    attributes = CellAttributes(image_id)
+    try:
+        mask = attributes.select(query.get_cell_ids(), query.filters)
+    except (KeyError, ValueError) as e:
+        raise HttpError(400, e.args[0])
+    return encode_id_runs(attributes.ids[mask])
+
+
+@api.get('/images/{image_id}/columns/stats', response=List[ColumnStatsSchema])
+@decorate_view(cache_response('image:{image_id}'))
+def column_stats(request, image_id):
+    stats = ColumnStats.objects.filter(image__id=image_id).order_by('id')
+    if not stats.exists():
+        # Images ingested before statistics were kept get them on first request
+        update_column_stats(get_object_or_404(Image, id=image_id))
+    return stats
 
 
 @api.get('/cells/columns')
+@decorate_view(cache_response())
 def cell_columns(request):
     return VECTOR_COLUMNS
 
 
 @api.get('/umap/transforms', response=List[UMAPTransformSchema])
+@decorate_view(cache_response('umap'))
 def transforms(request):
     return UMAPTransform.objects.all()
 
 
+def id_runs_response(id_runs, image_id=None):
+    # Optionally restricted to the cells of one image
+    if image_id is None:
+        return id_runs
+    image_ids = FeatureStore(image_id).ids
+    return encode_id_runs(IdRunSet.from_dict(id_runs).intersect(image_ids))
+
+
 @api.get('/umap/transforms/{transform_id}/fitted', response=List[int])
+@decorate_view(cache_response('umap'))
 @paginate()
-def transform_fitted(request, transform_id):
-    return [cell.id for cell in UMAPTransform.objects.get(id=transform_id).fitted_cells.all()]
+async def transform_fitted(request, transform_id):
+    transform = await aget_object_or_404(UMAPTransform, id=transform_id)
+    # Only the requested page is decoded from the runs
+    return IdRunSet.from_dict(transform.fitted_ids)
+
+
+@api.get('/umap/transforms/{transform_id}/fitted/runs', response=IdRuns)
+@decorate_view(cache_response('umap', 'image:{image_id}'))
+async def transform_fitted_runs(request, transform_id: int, image_id: int = None):
+    transform = await aget_object_or_404(UMAPTransform, id=transform_id)
+    return await sync_to_async(id_runs_response)(transform.fitted_ids, image_id)
+
+
+def similar_cells_response(transform_id, k, cell_id=None, vector=None):
+    transform = get_object_or_404(UMAPTransform, id=transform_id)
+    try:
+        return find_similar_cells(transform, cell_id, vector, k)
+    except FileNotFoundError:
+        raise HttpError(404, f'The fitted model of transform {transform_id} is missing.')
+    except (KeyError, ValueError) as e:
+        raise HttpError(400, e.args[0])
+
+
+@api.get('/umap/transforms/{transform_id}/similar', response=List[SimilarCell])
+def similar_cells(request, transform_id: int, query: Query[SimilarCellsQuery]):
+    # The k fitted cells nearest to a cell in the transform's input space
+    return similar_cells_response(transform_id, query.k, cell_id=query.cell_id)
+
+
+@api.post('/umap/transforms/{transform_id}/similar', response=List[SimilarCell])
+def similar_cells_vector(request, transform_id: int, query: SimilarCellsRequest):
+    # The k fitted cells nearest to a feature vector
+    return similar_cells_response(transform_id, query.k, vector=query.vector)
 
 
 @api.get('/umap/transforms/{transform_id}/results', response=List[UMAPResultSchema])
-def transform_results(request, transform_id):
-    return UMAPResult.objects.filter(transform__id=transform_id)
+@decorate_view(cache_response('umap'))
+async def transform_results(request, transform_id):
+    return [result async for result in UMAPResult.objects.filter(transform__id=transform_id)]
+
+
+@api.get('/umap/results/{result_id}/points')
+@decorate_view(cache_response('umap', 'image:{image_id}', store=False))
+async def result_points(request, result_id: int, image_id: int = None):
+    # Points of a result in the packed format of tcga.binary, optionally only those of one image
+    await aget_object_or_404(UMAPResult, id=result_id)
+    packed = await sync_to_async(pack_result_points)(result_id, image_id)
+    return streaming_packed_response(request, packed)
+
+
+@api.get('/umap/results/{result_id}/tiles/{z}/{x}/{y}')
+@decorate_view(cache_response('umap', 'image:{image_id}', store=False))
+async def result_tile(request, result_id: int, z: int, x: int, y: int, image_id: int = None):
+    # Tile of the [0, 1] x [0, 1] embedding of a result: points, or density bins when zoomed out
+    await aget_object_or_404(UMAPResult, id=result_id)
+    if z < 0 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HttpError(400, f'Tile {z}/{x}/{y} is outside the embedding.')
+    packed = await sync_to_async(pack_result_tile)(result_id, z, x, y, image_id)
+    return streaming_packed_response(request, packed)
 
 
 @api.get('/umap/results/{result_id}/transformed', response=List[int])
+@decorate_view(cache_response('umap'))
 @paginate()
-def result_transformed(request, result_id):
-    return [cell.id for cell in UMAPResult.objects.get(id=result_id).transformed_cells.all()]
+async def result_transformed(request, result_id):
+    result = await aget_object_or_404(UMAPResult, id=result_id)
+    return IdRunSet.from_dict(result.transformed_ids)
+
+
+@api.get('/umap/results/{result_id}/transformed/runs', response=IdRuns)
+@decorate_view(cache_response('umap', 'image:{image_id}'))
+async def result_transformed_runs(request, result_id: int, image_id: int = None):
+    result = await aget_object_or_404(UMAPResult, id=result_id)
+    return await sync_to_async(id_runs_response)(result.transformed_ids, image_id)
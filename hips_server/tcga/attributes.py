@@ -0,0 +1,174 @@
+import numpy as np
+
+from functools import cached_property
+
+from django.db.models import Q
+
+from tcga.models import Cell, ColumnStats, INDEXED_FIELDS
+from tcga.feature_store import FeatureStore, NUMERIC, CATEGORICAL
+from tcga.spatial_index import get_spatial_index, GEOMETRY_FIELDS
+
+
+CLASSIFICATION = 'classification'
+# Numeric values are compared to filter ranges at the precision the viewer shows them with
+FILTER_PRECISION = 2
+# Rounding to FILTER_PRECISION significant digits changes a value by less than this fraction of it
+FILTER_MARGIN = 10.0 ** (1 - FILTER_PRECISION)
+# Filters on indexed Cell fields run as SQL first when they are expected to match at most
+# this fraction of the cells of an image with at least MIN_INDEXED_CELLS cells; fetching an id
+# from an index costs about as much as comparing the values of 15 cells in a scan
+MAX_INDEXED_FRACTION = 0.01
+MIN_INDEXED_CELLS = 100000
+ID_CHUNK_SIZE = 10000
+
+
+def round_significant(values, digits):
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.floor(np.log10(np.abs(values)))
+    factor = 10.0 ** (digits - 1 - np.where(np.isfinite(magnitude), magnitude, 0))
+    # Round halves away from zero, like Number.toPrecision
+    return np.sign(values) * np.floor(np.abs(values) * factor + 0.5) / factor
+
+
+def estimate_fraction(stats, accepted):
+    # Fraction of cells expected to pass a filter, from the ColumnStats of its attribute
+    if not stats.count:
+        return 0
+    if stats.kind == CATEGORICAL:
+        matched = sum(stats.categories.get(value, 0) for value in accepted)
+    elif len(accepted) != 2:
+        return 1
+    elif stats.minimum is None:
+        matched = 0
+    else:
+        low, high = accepted
+        # Piecewise-linear CDF through the stored quantiles
+        quantiles = sorted((float(q), v) for q, v in stats.quantiles.items())
+        points = [stats.minimum, *[v for _, v in quantiles], stats.maximum]
+        fractions = [0, *[q for q, _ in quantiles], 1]
+        present = stats.count - stats.null_count
+        matched = present * (np.interp(high, points, fractions) - np.interp(low, points, fractions))
+    return (matched + stats.null_count) / stats.count
+
+
+def query_indexed_filters(image_id, filters):
+    """
+    Ids of a superset of the cells of an Image that pass the filters on classification
+    and indexed Cell fields, queried with the database indexes; None when no such filter
+    is selective enough for that to be faster than scanning every cell.
+    Numeric ranges are widened by FILTER_MARGIN to include values that round into them.
+    """
+    indexed = {
+        name: accepted for name, accepted in (filters or {}).items()
+        if len(accepted) and (name == CLASSIFICATION or name in INDEXED_FIELDS)
+    }
+    if not indexed:
+        return None
+    stats = ColumnStats.objects.filter(image__id=image_id, name__in=list(indexed))
+    fractions = [estimate_fraction(s, indexed[s.name]) for s in stats if s.count >= MIN_INDEXED_CELLS]
+    if not fractions or min(fractions) > MAX_INDEXED_FRACTION:
+        return None
+    cells = Cell.objects.filter(image__id=image_id)
+    for name, accepted in indexed.items():
+        if name == CLASSIFICATION:
+            cells = cells.filter(classification__in=accepted)
+        elif len(accepted) == 2:
+            low, high = accepted
+            field = INDEXED_FIELDS[name]
+            cells = cells.filter(
+                Q(**{f'{field}__isnull': True})
+                | Q(**{f'{field}__range': (
+                    low - FILTER_MARGIN * abs(low), high + FILTER_MARGIN * abs(high),
+                )})
+            )
+    return np.fromiter(
+        cells.values_list('id', flat=True).iterator(chunk_size=ID_CHUNK_SIZE), dtype=np.int64,
+    )
+
+
+class CellAttributes:
+    """
+    Every attribute of the cells of one Image as a column in id order: geometry fields
+    and classification from the SpatialIndex, feature vector columns from the FeatureStore.
+    Numeric columns are float32 with NaN for null; categorical columns are int32 codes
+    into a list of categories, with -1 for null.
+    """
+
+    def __init__(self, image_id):
+        self.image_id = image_id
+        self.store = FeatureStore(image_id)
+        self.index = get_spatial_index(image_id)
+
+    @cached_property
+    def ids(self):
+        # The spatial index holds every cell; read its ids back into id order
+        return self.index.ids(self.index.order)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def names(self):
+        return [*GEOMETRY_FIELDS, CLASSIFICATION, *(self.store.columns if self.store.exists() else [])]
+
+    def is_numeric(self, name):
+        if name in GEOMETRY_FIELDS:
+            return True
+        if name == CLASSIFICATION:
+            return False
+        return self.store.kinds.get(name) == NUMERIC
+
+    def values(self, name):
+        """Returns (values, categories); categories is None for numeric columns."""
+        if name in GEOMETRY_FIELDS:
+            return self.index.geometry(name, self.index.order), None
+        if name == CLASSIFICATION:
+            return self.index.codes(self.index.order), self.index.classes
+        if not self.store.exists() or name not in self.store.kinds:
+            raise KeyError(f'Unknown attribute "{name}".')
+        if len(self.store) != len(self):
+            raise ValueError(f'Features of image {self.image_id} do not match its cells.')
+        if self.store.kinds[name] == NUMERIC:
+            return self.store.values(name), None
+        return self.store.codes(name), self.store.categories(name)
+
+    def select(self, cell_ids=None, filters=None):
+        """
+        Boolean mask over the cells in id order: cells in cell_ids (if given) that pass every filter.
+        Filters map an attribute to a [min, max] range for numeric attributes
+        or to a list of accepted values for categorical ones; an empty list accepts everything.
+        As in the viewer, numeric values are rounded to FILTER_PRECISION significant digits
+        before comparison, and cells without a value for a filtered attribute pass that filter.
+        Without cell_ids, selective filters on indexed attributes first narrow down the cells in SQL.
+        """
+        if cell_ids is None:
+            cell_ids = query_indexed_filters(self.image_id, filters)
+        # Only the values of the rows that may pass are read and compared
+        rows = slice(None) if cell_ids is None else self.rows_for_ids(cell_ids)
+        keep = np.ones(len(self.ids[rows]), dtype=bool)
+        for name, accepted in (filters or {}).items():
+            if not len(accepted):
+                continue
+            values, categories = self.values(name)
+            values = values[rows]
+            if categories is None:
+                if len(accepted) != 2:
+                    raise ValueError(f'Filter on numeric attribute "{name}" must be a [min, max] range.')
+                low, high = accepted
+                rounded = round_significant(values, FILTER_PRECISION)
+                keep &= np.isnan(rounded) | ((rounded >= low) & (rounded <= high))
+            else:
+                codes = [i for i, value in enumerate(categories) if value in accepted]
+                keep &= (values < 0) | np.isin(values, codes)
+        mask = np.zeros(len(self), dtype=bool)
+        mask[rows] = keep
+        return mask
+
+    def rows_for_ids(self, cell_ids):
+        # Rows of the given ids that belong to this image; other ids are ignored
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        rows = np.searchsorted(self.ids, cell_ids)
+        found = rows < len(self)
+        found[found] = self.ids[rows[found]] == cell_ids[found]
+        return rows[found]
@@ -0,0 +1,216 @@
+import json
+import math
+import numpy as np
+
+from asgiref.sync import sync_to_async
+
+from tcga.feature_store import FeatureStore, NUMERIC
+from tcga.spatial_index import get_spatial_index
+from tcga.result_store import ResultPoints
+from tcga.result_tiles import MAX_TILE_POINTS, get_result_tiles
+
+
+# Packed binary column format, used to send whole columns of data to the client
+# without JSON encoding:
+#   uint32       little-endian length of the header in bytes
+#   header       UTF-8 JSON, padded with spaces so that the first column starts at a multiple of 8:
+#                {"count": rows, "columns": [{"name", "dtype", "categories" (optional)}, ...], ...}
+#                plus any extra metadata of the payload
+#   columns      one after the other in header order, each as `count` raw little-endian values
+#                of its dtype, padded with zero bytes to a multiple of 8
+# Categorical columns are int32 codes into their "categories" list, with -1 for null.
+# float32 columns use NaN for null.
+CONTENT_TYPE = 'application/octet-stream'
+ALIGNMENT = 8
+STREAM_CHUNK_ROWS = 1 << 16
+DTYPES = {
+    'float64': np.dtype('<f8'),
+    'float32': np.dtype('<f4'),
+    'int32': np.dtype('<i4'),
+}
+CELL_GEOMETRY_FIELDS = ['x', 'y', 'width', 'height', 'orientation']
+# Viewport queries return individual cells up to this many image pixels per screen pixel,
+# and density bins of about BIN_SCREEN_SIZE screen pixels when zoomed out further
+DETAIL_DOWNSAMPLE = 8
+BIN_SCREEN_SIZE = 16
+MAX_VIEWPORT_CELLS = 200000
+
+
+def padding(size):
+    return -size % ALIGNMENT
+
+
+class PackedColumns:
+    """
+    Collects named columns of equal length and streams them in the packed binary column format,
+    by sync or async iteration. Column values may be numpy arrays or memmaps, or callables
+    taking a slice of rows; they are only read, in chunks, while the payload is being streamed.
+    """
+
+    def __init__(self, count, **meta):
+        self.count = count
+        self.meta = meta
+        self.columns = []
+
+    def add(self, name, dtype, values, categories=None):
+        column = dict(name=name, dtype=dtype)
+        if categories is not None:
+            column['categories'] = categories
+        self.columns.append((column, values))
+
+    def header(self):
+        header = json.dumps(dict(
+            count=self.count,
+            columns=[column for column, _ in self.columns],
+            **self.meta,
+        )).encode()
+        header += b' ' * padding(4 + len(header))
+        return np.uint32(len(header)).astype('<u4').tobytes() + header
+
+    def __len__(self):
+        # Total payload size in bytes, known before streaming starts
+        column_sizes = [
+            self.count * DTYPES[column['dtype']].itemsize for column, _ in self.columns
+        ]
+        return len(self.header()) + sum(size + padding(size) for size in column_sizes)
+
+    def __iter__(self):
+        yield self.header()
+        for column, values in self.columns:
+            dtype = DTYPES[column['dtype']]
+            for start in range(0, self.count, STREAM_CHUNK_ROWS):
+                rows = slice(start, start + STREAM_CHUNK_ROWS)
+                chunk = values(rows) if callable(values) else values[rows]
+                yield np.ascontiguousarray(chunk, dtype=dtype).tobytes()
+            yield b'\0' * padding(self.count * dtype.itemsize)
+
+    async def __aiter__(self):
+        # Chunks are read and converted in worker threads, so that an ASGI server
+        # can stream several payloads at once without blocking its event loop
+        chunks = iter(self)
+        next_chunk = sync_to_async(next, thread_sensitive=False)
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+
+
+def pack_image_cells(image_id):
+    """
+    Pack every Cell of an Image, ordered by id: id, geometry fields, classification
+    and, when the image has a FeatureStore, every feature vector column.
+    Cells are read from the memory-mapped SpatialIndex of the image rather than the database.
+    """
+    index = get_spatial_index(image_id)
+    order = index.order
+    ids = index.ids(order)
+    count = len(ids)
+
+    packed = PackedColumns(count)
+    # ids fit exactly into float64, which the client reads as plain numbers
+    packed.add('id', 'float64', ids)
+    for name in CELL_GEOMETRY_FIELDS:
+        packed.add(name, 'float32', lambda r, name=name: index.geometry(name, order[r]))
+    packed.add('classification', 'int32', lambda r: index.codes(order[r]), index.classes)
+
+    store = FeatureStore(image_id)
+    if store.exists() and count:
+        rows = store.rows_for_ids(ids)
+        for name in store.columns:
+            if store.kinds[name] == NUMERIC:
+                column = store.values(name)
+                packed.add(name, 'float32', lambda r, column=column: column[rows[r]])
+            else:
+                codes = store.codes(name)
+                packed.add(
+                    name, 'int32', lambda r, codes=codes: codes[rows[r]],
+                    store.categories(name),
+                )
+    return packed
+
+
+def pack_viewport(image_id, bbox, zoom, max_zoom):
+    """
+    Pack the cells of an Image inside a (left, top, right, bottom) box for display
+    at a geojs zoom level: individual cells (id, geometry and classification) when zoomed in,
+    otherwise pre-aggregated bins (origin, total count and one count column per classification).
+    """
+    index = get_spatial_index(image_id)
+    downsample = 2 ** max(max_zoom - zoom, 0)
+    if downsample <= DETAIL_DOWNSAMPLE and index.count(bbox) <= MAX_VIEWPORT_CELLS:
+        rows = index.query(bbox)
+        packed = PackedColumns(len(rows), level='cells')
+        packed.add('id', 'float64', index.ids(rows))
+        for name in CELL_GEOMETRY_FIELDS:
+            packed.add(name, 'float32', index.geometry(name, rows))
+        packed.add('classification', 'int32', index.codes(rows), index.classes)
+        return packed
+
+    # Bins merge a power of two of grid cells in each direction
+    factor = 2 ** max(int(math.log2(BIN_SCREEN_SIZE * downsample / index.cell_size)), 0)
+    bins = index.bins(bbox, factor)
+    packed = PackedColumns(len(bins['x']), level='bins', bin_size=bins['size'])
+    packed.add('x', 'float64', bins['x'])
+    packed.add('y', 'float64', bins['y'])
+    packed.add('count', 'int32', bins['counts'].sum(axis=1))
+    for i, name in enumerate(index.classes):
+        packed.add(name, 'int32', bins['counts'][:, i])
+    return packed
+
+
+def pack_result_points(result_id, image_id=None):
+    """Pack the points of a UMAPResult, ordered by cell id: id, x and y."""
+    points = ResultPoints(result_id)
+    rows = slice(None) if image_id is None else points.rows_for_image(image_id)
+    ids = points.ids[rows]
+    packed = PackedColumns(len(ids), result=result_id, image=image_id)
+    packed.add('id', 'float64', ids)
+    packed.add('x', 'float32', points.x[rows])
+    packed.add('y', 'float32', points.y[rows])
+    return packed
+
+
+def pack_result_tile(result_id, z, x, y, image_id=None):
+    """
+    Pack tile (z, x, y) of the embedding of a UMAPResult, optionally only the cells of one image:
+    its points (id, x, y and classification) when there are few enough of them,
+    otherwise pre-aggregated bins (origin, total count and one count column per classification,
+    or the count of the image alone).
+    """
+    tiles = get_result_tiles(result_id)
+    rows = tiles.point_rows(z, x, y)
+    point_rows = tiles.order[rows]
+    classes = tiles.point_classes[rows]
+    if image_id is not None:
+        in_image = tiles.point_images[rows] == (
+            tiles.images.index(image_id) if image_id in tiles.images else -1
+        )
+        point_rows, classes = point_rows[in_image], classes[in_image]
+    if z >= tiles.levels or len(point_rows) <= MAX_TILE_POINTS:
+        packed = PackedColumns(len(point_rows), level='points', result=result_id, image=image_id)
+        packed.add('id', 'float64', tiles.points.ids[point_rows])
+        packed.add('x', 'float32', tiles.points.x[point_rows])
+        packed.add('y', 'float32', tiles.points.y[point_rows])
+        packed.add('classification', 'int32', classes, tiles.classes)
+        return packed
+
+    bins = tiles.bins(z, x, y)
+    if image_id is not None:
+        if image_id not in tiles.images:
+            counts = np.zeros(len(bins['x']), dtype=np.int32)
+        else:
+            counts = bins['image_counts'][:, tiles.images.index(image_id)]
+        keep = counts > 0
+        packed = PackedColumns(
+            int(keep.sum()), level='bins', bin_size=bins['size'], result=result_id, image=image_id,
+        )
+        packed.add('x', 'float64', bins['x'][keep])
+        packed.add('y', 'float64', bins['y'][keep])
+        packed.add('count', 'int32', counts[keep])
+        return packed
+
+    packed = PackedColumns(len(bins['x']), level='bins', bin_size=bins['size'], result=result_id)
+    packed.add('x', 'float64', bins['x'])
+    packed.add('y', 'float64', bins['y'])
+    packed.add('count', 'int32', bins['image_counts'].sum(axis=1))
+    for i, name in enumerate(tiles.classes):
+        packed.add(name, 'int32', bins['class_counts'][:, i])
+    return packed
@@ -0,0 +1,56 @@
+import numpy as np
+
+from datetime import datetime
+from django.db import transaction
+
+from tcga.models import ColumnStats
+from tcga.attributes import CellAttributes
+from tcga.feature_store import to_json_floats, NUMERIC, CATEGORICAL
+
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+
+def get_column_stats(name, values, categories):
+    stats = dict(name=name, count=len(values))
+    if categories is None:
+        present = np.asarray(values[~np.isnan(values)], dtype=np.float64)
+        stats.update(kind=NUMERIC, null_count=len(values) - len(present))
+        if len(present):
+            minimum, maximum = to_json_floats([present.min(), present.max()]).tolist()
+            stats.update(
+                minimum=minimum,
+                maximum=maximum,
+                mean=float(present.mean()),
+                std=float(present.std()),
+                quantiles=dict(zip(
+                    [str(q) for q in QUANTILES],
+                    np.quantile(present, QUANTILES).tolist(),
+                )),
+            )
+    else:
+        codes = np.asarray(values)
+        counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+        stats.update(
+            kind=CATEGORICAL,
+            null_count=int((codes < 0).sum()),
+            categories={
+                value: int(count) for value, count in zip(categories, counts) if count
+            },
+        )
+    return stats
+
+
+def update_column_stats(image):
+    """Replace the ColumnStats of an Image with statistics of every cell attribute."""
+    start = datetime.now()
+    attributes = CellAttributes(image.id)
+    stats = [
+        ColumnStats(image=image, **get_column_stats(name, *attributes.values(name)))
+        for name in attributes.names
+    ]
+    with transaction.atomic():
+        ColumnStats.objects.filter(image=image).delete()
+        ColumnStats.objects.bulk_create(stats)
+    seconds = (datetime.now() - start).total_seconds()
+    print(f'Computed statistics of {len(stats)} columns in {seconds} seconds.')
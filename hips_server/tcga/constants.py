@@ -6,6 +6,12 @@ SAMPLE_DATA_COLLECTION = '686fddd7f5546bd5eacbe40b'
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 DOWNLOADS_FOLDER = Path(PROJECT_ROOT, 'data', 'downloads')
 TRANSFORMS_FOLDER = Path(PROJECT_ROOT, 'data', 'transforms')
+FEATURES_FOLDER = Path(PROJECT_ROOT, 'data', 'features')
+UMAP_INPUTS_FOLDER = Path(PROJECT_ROOT, 'data', 'umap_inputs')
+RESULTS_FOLDER = Path(PROJECT_ROOT, 'data', 'results')
+RESPONSES_FOLDER = Path(PROJECT_ROOT, 'data', 'responses')
+METRICS_FOLDER = Path(PROJECT_ROOT, 'data', 'metrics')
+PROFILES_FOLDER = Path(PROJECT_ROOT, 'data', 'profiles')
 IMAGE_SUFFIXES = ['.svs']
 VECTOR_COLUMNS = [
     'Identifier.ObjectCode',
@@ -185,6 +191,15 @@ VECTOR_COLUMNS = [
     'Cytoplasm.Haralick.IMC2.Mean',
     'Cytoplasm.Haralick.IMC2.Range'
 ]
+# VECTOR_COLUMNS holding strings; every other column is numeric
+CATEGORICAL_COLUMNS = [
+    'Classif.StandardClass',
+    'Classif.SuperClass',
+    'Unconstrained.Classif.StandardClass',
+    'Unconstrained.Classif.SuperClass',
+    'slide',
+    'roiname',
+]
 # from https://umap-learn.readthedocs.io/en/latest/api.html
 DEFAULT_UMAP_KWARGS = dict(
     n_neighbors=15,
@@ -0,0 +1,170 @@
+import os
+import hashlib
+import threading
+import requests
+import girder_client
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from tcga.constants import IMAGE_SUFFIXES
+
+
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+PARTIAL_SUFFIX = '.part'
+
+
+class DownloadError(Exception):
+    pass
+
+
+class CaseDownloader:
+    """
+    Downloads case data from a Girder server with a bounded pool of threads.
+
+    Each thread reuses one HTTP session. Files are written to a partial file first,
+    resumed with a Range request if a previous attempt was interrupted, and verified
+    against the size (and sha512, when the server provides one) in the file metadata.
+    Files already present with the expected size are skipped unless overwrite is set.
+    """
+
+    def __init__(self, api_url, workers=DOWNLOAD_WORKERS, overwrite=False):
+        self.client = girder_client.GirderClient(apiUrl=api_url)
+        self.workers = workers
+        self.overwrite = overwrite
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if self.client.token:
+                session.headers['Girder-Token'] = self.client.token
+            self.local.session = session
+        return self.local.session
+
+    def get(self, path, **params):
+        response = self.session.get(self.client.urlBase + path, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def list_cases(self, collection_id, cases=None):
+        """Find case folders and their image item. Cases without an image are skipped."""
+        results = []
+        for folder in self.client.listFolder(collection_id):
+            case_name = folder.get('name')
+            if case_name in (cases or []) or (
+                not cases and case_name != 'test'
+            ):
+                image_matches = [
+                    item for item in self.client.listItem(folder.get('_id'))
+                    if any(
+                        item.get('name', '').endswith(suffix)
+                        for suffix in IMAGE_SUFFIXES
+                    )
+                ]
+                if not len(image_matches):
+                    print(f'ERROR: Could not find an item in {case_name} that ends with an image suffix. Skipping case.')
+                    continue
+                results.append(dict(
+                    name=case_name,
+                    folder_id=folder.get('_id'),
+                    image_item_id=image_matches[0].get('_id'),
+                ))
+        return results
+
+    def download_case(self, case, case_folder):
+        """Download the nuclei data folders of a case into case_folder."""
+        start = datetime.now()
+        jobs = []
+        for data_folder in self.client.listFolder(case['folder_id']):
+            # Find nucleiMeta and nucleiProps folders
+            data_folder_name = data_folder.get('name')
+            if 'nuclei' in data_folder_name:
+                jobs += self.list_folder_items(data_folder.get('_id'), case_folder / data_folder_name)
+        futures = [self.executor.submit(self.download_item, *job) for job in jobs]
+        total = sum(future.result() for future in futures)
+        seconds = (datetime.now() - start).total_seconds()
+        rate = total / seconds / 1e6 if seconds else 0
+        print(f'Downloaded {total / 1e6:.1f} MB for {case["name"]} in {seconds} seconds ({rate:.1f} MB/s).')
+        return total
+
+    def list_folder_items(self, folder_id, dest):
+        # Mirrors the layout of GirderClient.downloadFolderRecursive
+        jobs = []
+        for folder in self.client.listFolder(folder_id):
+            jobs += self.list_folder_items(
+                folder['_id'], dest / self.client.transformFilename(folder['name'])
+            )
+        for item in self.client.listItem(folder_id):
+            jobs.append((item, dest))
+        return jobs
+
+    def download_item(self, item, dest):
+        files = self.get(f'item/{item["_id"]}/files', limit=0)
+        name = self.client.transformFilename(item['name'])
+        if len(files) == 1 and files[0]['name'] == item['name']:
+            return self.download_file(files[0], dest / name)
+        return sum(
+            self.download_file(file, dest / name / self.client.transformFilename(file['name']))
+            for file in files
+        )
+
+    def download_file(self, file, path):
+        """Download one file unless already complete; returns the number of bytes fetched."""
+        size = file.get('size')
+        if path.exists() and not self.overwrite and path.stat().st_size == size:
+            return 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = Path(str(path) + PARTIAL_SUFFIX)
+        offset = partial.stat().st_size if partial.exists() and not self.overwrite else 0
+        if size is not None and offset > size:
+            offset = 0
+        fetched = 0
+        if size is None or offset < size or not offset:
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            url = f'{self.client.urlBase}file/{file["_id"]}/download'
+            with self.session.get(url, headers=headers, stream=True) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # Server ignored the Range header; start over
+                    offset = 0
+                with open(partial, 'ab' if offset else 'wb') as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        fetched += len(chunk)
+        self.verify_file(file, partial)
+        os.replace(partial, path)
+        return fetched
+
+    def verify_file(self, file, path):
+        size = file.get('size')
+        actual = path.stat().st_size
+        if size is not None and actual != size:
+            if actual > size:
+                path.unlink()
+            # a short partial file is kept so the next attempt resumes it
+            raise DownloadError(f'Size mismatch for {path}: expected {size}, got {actual}.')
+        if file.get('sha512'):
+            digest = hashlib.sha512()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            if digest.hexdigest() != file['sha512']:
+                path.unlink()
+                raise DownloadError(f'Checksum mismatch for {path}.')
@@ -0,0 +1,296 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+from functools import cached_property
+
+from tcga.constants import FEATURES_FOLDER, VECTOR_COLUMNS, CATEGORICAL_COLUMNS
+
+
+# On-disk layout of a feature store, one folder per Image:
+#   schema.json  column names and kinds, plus the dictionary of each categorical column
+#   ids.i64      sorted cell ids; row i of every column belongs to cell ids[i]
+#   NNN.f32      numeric column NNN (position in schema) as raw float32, NaN for null
+#   NNN.i32      categorical column NNN as raw int32 dictionary codes, -1 for null
+SCHEMA_FILE = 'schema.json'
+IDS_FILE = 'ids.i64'
+NUMERIC = 'numeric'
+CATEGORICAL = 'categorical'
+DTYPES = {NUMERIC: np.float32, CATEGORICAL: np.int32}
+SUFFIXES = {NUMERIC: 'f32', CATEGORICAL: 'i32'}
+
+
+def get_default_schema():
+    return dict(
+        columns=[
+            dict(name=c, kind=CATEGORICAL if c in CATEGORICAL_COLUMNS else NUMERIC)
+            for c in VECTOR_COLUMNS
+        ],
+        categories={c: [] for c in CATEGORICAL_COLUMNS},
+    )
+
+
+def to_float32(values):
+    # non-numeric values, NaN and Inf all become NaN (null)
+    array = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(
+        dtype=np.float64, na_value=np.nan, copy=True
+    )
+    array[np.isinf(array)] = np.nan
+    return array.astype(np.float32)
+
+
+def to_json_floats(array):
+    # float32 -> shortest decimal repr -> float64 avoids float32 noise in JSON output
+    return np.asarray(array, dtype=np.float32).astype('U16').astype(np.float64)
+
+
+def encode_columns(frame):
+    """
+    Encode a vector DataFrame into compact typed arrays, one entry per store column:
+    float32 values for numeric columns and (int32 codes, values) for categorical columns.
+    """
+    columns = {}
+    for column in get_default_schema()['columns']:
+        name = column['name']
+        if column['kind'] == CATEGORICAL:
+            codes, uniques = pd.factorize(pd.Series(frame[name]), use_na_sentinel=True)
+            columns[name] = (codes.astype(np.int32), [str(v) for v in uniques])
+        else:
+            columns[name] = to_float32(frame[name])
+    return columns
+
+
+def slice_columns(columns, rows):
+    return {
+        name: (values[0][rows], values[1]) if isinstance(values, tuple) else values[rows]
+        for name, values in columns.items()
+    }
+
+
+class FeatureStore:
+    """Read-only, memory-mapped view of the feature vectors of every cell in one Image."""
+
+    def __init__(self, image_id):
+        self.image_id = image_id
+        self.folder = FEATURES_FOLDER / str(image_id)
+
+    def exists(self):
+        return (self.folder / SCHEMA_FILE).exists()
+
+    def delete(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    @cached_property
+    def schema(self):
+        if not self.exists():
+            return get_default_schema()
+        with open(self.folder / SCHEMA_FILE) as f:
+            return json.load(f)
+
+    @cached_property
+    def columns(self):
+        return [c['name'] for c in self.schema['columns']]
+
+    @cached_property
+    def kinds(self):
+        return {c['name']: c['kind'] for c in self.schema['columns']}
+
+    @property
+    def numeric_columns(self):
+        return [c for c in self.columns if self.kinds[c] == NUMERIC]
+
+    @property
+    def categorical_columns(self):
+        return [c for c in self.columns if self.kinds[c] == CATEGORICAL]
+
+    def column_path(self, name):
+        index = self.columns.index(name)
+        return self.folder / f'{index:03d}.{SUFFIXES[self.kinds[name]]}'
+
+    def _memmap(self, path, dtype):
+        if not path.exists() or path.stat().st_size == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    @cached_property
+    def ids(self):
+        return self._memmap(self.folder / IDS_FILE, np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def categories(self, name):
+        return self.schema['categories'].get(name, [])
+
+    def codes(self, name, rows=None):
+        if self.kinds[name] != CATEGORICAL:
+            raise ValueError(f'Column "{name}" is not categorical.')
+        codes = self._memmap(self.column_path(name), np.int32)
+        return codes if rows is None else codes[rows]
+
+    def values(self, name, rows=None):
+        """Numeric columns as float32 (NaN for null); categorical columns decoded to objects."""
+        if name not in self.kinds:
+            raise KeyError(f'Unknown column "{name}".')
+        if self.kinds[name] == NUMERIC:
+            values = self._memmap(self.column_path(name), np.float32)
+            return values if rows is None else values[rows]
+        codes = self.codes(name, rows)
+        lookup = np.array([*self.categories(name), None], dtype=object)
+        # code -1 (null) indexes the trailing None
+        return lookup[codes]
+
+    def matrix(self, columns, rows=None):
+        """Stack numeric columns into a (rows, columns) float32 array."""
+        count = len(self.ids if rows is None else self.ids[rows])
+        matrix = np.empty((count, len(columns)), dtype=np.float32)
+        for i, name in enumerate(columns):
+            matrix[:, i] = self.values(name, rows)
+        return matrix
+
+    def rows_for_ids(self, cell_ids):
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        rows = np.searchsorted(self.ids, cell_ids)
+        found = rows < len(self.ids)
+        found[found] = self.ids[rows[found]] == cell_ids[found]
+        if not found.all():
+            raise KeyError(f'{(~found).sum()} cell ids not found in features of image {self.image_id}.')
+        return rows
+
+    def id_range(self, start=None, stop=None):
+        """Slice of rows for cells with start <= id < stop."""
+        lo = 0 if start is None else int(np.searchsorted(self.ids, start, side='left'))
+        hi = len(self.ids) if stop is None else int(np.searchsorted(self.ids, stop, side='left'))
+        return slice(lo, hi)
+
+    def vectors(self, rows, columns=None):
+        """JSON-ready row lists in column order, with None for null values."""
+        columns = columns or self.columns
+        ids = self.ids[rows]
+        output = np.empty((len(ids), len(columns)), dtype=object)
+        for i, name in enumerate(columns):
+            if self.kinds[name] == NUMERIC:
+                floats = to_json_floats(self.values(name, rows))
+                values = floats.astype(object)
+                values[np.isnan(floats)] = None
+                output[:, i] = values
+            else:
+                output[:, i] = self.values(name, rows)
+        return output.tolist()
+
+
+class FeatureStoreWriter:
+    """Appends batches of cell vectors to the FeatureStore of one Image."""
+
+    def __init__(self, image_id):
+        self.store = FeatureStore(image_id)
+        self.schema = self.store.schema
+        self.store.folder.mkdir(parents=True, exist_ok=True)
+        self.category_codes = {
+            name: {v: i for i, v in enumerate(values)}
+            for name, values in self.schema['categories'].items()
+        }
+        self.truncate_rows()
+
+    def _paths(self):
+        return [(self.store.folder / IDS_FILE, np.int64)] + [
+            (self.store.column_path(c['name']), DTYPES[c['kind']])
+            for c in self.schema['columns']
+        ]
+
+    def truncate_rows(self):
+        # A batch interrupted while being appended leaves some files longer than others;
+        # cut every file back to the rows that all of them hold
+        ids_path = self.store.folder / IDS_FILE
+        if not ids_path.exists():
+            return
+        paths = self._paths()
+        rows = min(
+            path.stat().st_size // np.dtype(dtype).itemsize if path.exists() else 0
+            for path, dtype in paths
+        )
+        for path, dtype in paths:
+            size = rows * np.dtype(dtype).itemsize
+            if path.exists() and path.stat().st_size != size:
+                os.truncate(path, size)
+
+    def _map_codes(self, name, codes, values):
+        # map codes into a batch-local dictionary onto the image-wide dictionary
+        lookup = self.category_codes[name]
+        categories = self.schema['categories'][name]
+        mapping = np.empty(len(values) + 1, dtype=np.int32)
+        for i, value in enumerate(values):
+            if value not in lookup:
+                lookup[value] = len(categories)
+                categories.append(value)
+            mapping[i] = lookup[value]
+        # local null code -1 indexes the trailing null code
+        mapping[-1] = -1
+        return mapping[codes]
+
+    def append(self, cell_ids, frame):
+        """Write one batch; frame rows correspond to cell_ids and hold every schema column."""
+        self.append_columns(cell_ids, encode_columns(frame))
+
+    def append_columns(self, cell_ids, columns):
+        """Write one batch of columns already encoded by encode_columns."""
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        # Check every column before writing anything, so a bad batch leaves all files as they were
+        for column in self.schema['columns']:
+            values = columns[column['name']]
+            if len(values[0] if column['kind'] == CATEGORICAL else values) != len(cell_ids):
+                raise ValueError('Number of cell ids does not match number of vector rows.')
+        with open(self.store.folder / IDS_FILE, 'ab') as f:
+            cell_ids.tofile(f)
+        for column in self.schema['columns']:
+            name, kind = column['name'], column['kind']
+            if kind == CATEGORICAL:
+                values = self._map_codes(name, *columns[name])
+            else:
+                values = columns[name]
+            with open(self.store.column_path(name), 'ab') as f:
+                values.astype(DTYPES[kind]).tofile(f)
+
+    def remove_rows(self, remove):
+        """Drop the rows selected by a boolean mask over the current rows, compacting every file."""
+        ids_path = self.store.folder / IDS_FILE
+        if not ids_path.exists() or not remove.any():
+            return
+        keep = ~remove
+        for path, dtype in self._paths():
+            values = np.fromfile(path, dtype=dtype)
+            tmp_path = path.with_suffix(path.suffix + '.tmp')
+            values[keep].tofile(tmp_path)
+            os.replace(tmp_path, path)
+
+    def remove_id_ranges(self, id_ranges, keep=False):
+        """
+        Drop rows with ids inside any of the inclusive (first, last) ranges,
+        or outside all of them when keep is True.
+        """
+        ids_path = self.store.folder / IDS_FILE
+        if not ids_path.exists():
+            return
+        ids = np.fromfile(ids_path, dtype=np.int64)
+        # ranges do not overlap, so each id can only fall in the last range starting before it
+        id_ranges = np.array(sorted(id_ranges), dtype=np.int64).reshape(-1, 2)
+        inside = np.zeros(len(ids), dtype=bool)
+        if len(id_ranges):
+            index = np.searchsorted(id_ranges[:, 0], ids, side='right') - 1
+            inside = (index >= 0) & (ids <= id_ranges[np.maximum(index, 0), 1])
+        self.remove_rows(~inside if keep else inside)
+
+    def flush(self):
+        with open(self.store.folder / SCHEMA_FILE, 'w') as f:
+            json.dump(self.schema, f)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
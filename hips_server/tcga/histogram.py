@@ -0,0 +1,95 @@
+import numpy as np
+
+from tcga.attributes import CellAttributes
+from tcga.feature_store import to_json_floats
+
+
+DEFAULT_BUCKETS = 50
+
+
+def get_id_ranges(ids, groups, n_groups):
+    """
+    For each group, the sorted ids of its members as inclusive [first, last] runs
+    of consecutive ids, which are compact because cells of an ROI get consecutive ids.
+    """
+    order = np.lexsort((ids, groups))
+    ids, groups = ids[order], groups[order]
+    # A run starts at every change of group or gap in the ids
+    starts = np.ones(len(ids), dtype=bool)
+    starts[1:] = (groups[1:] != groups[:-1]) | (ids[1:] != ids[:-1] + 1)
+    start_rows = np.flatnonzero(starts)
+    end_rows = np.append(start_rows, len(ids))[1:] - 1
+    runs = np.stack([ids[start_rows], ids[end_rows]], axis=1).tolist()
+    run_groups = groups[start_rows]
+    bounds = np.searchsorted(run_groups, np.arange(n_groups + 1))
+    return [runs[bounds[i]:bounds[i + 1]] for i in range(n_groups)]
+
+
+def get_distinct_values(values, limit):
+    # Sorted distinct non-null values if there are at most limit of them, otherwise None.
+    # Most numeric attributes have many distinct values, which a sample shows without a full sort.
+    if len(np.unique(values[:limit * 100])) > limit + 1:
+        return None
+    distinct = np.unique(values)
+    distinct = distinct[~np.isnan(distinct)]
+    return distinct if len(distinct) <= limit else None
+
+
+def compute_histogram(
+    image_id, attribute, buckets=DEFAULT_BUCKETS, scale='linear',
+    cell_ids=None, filters=None, bucket_ids=False,
+):
+    """
+    Histogram of one cell attribute over the cells selected by cell_ids and filters
+    (see CellAttributes.select).
+
+    Categorical attributes, and numeric attributes with fewer distinct values than buckets,
+    get one count per value ("keys"). Other numeric attributes get counts for equal-width
+    buckets ("edges") between the minimum and maximum over all cells of the image,
+    equal-width in log10 when scale is "log". Cells without a value are counted as nulls.
+    With bucket_ids, the ids of the cells in each bucket are returned as [first, last] runs.
+    """
+    attributes = CellAttributes(image_id)
+    values, categories = attributes.values(attribute)
+    mask = attributes.select(cell_ids, filters)
+    selected = np.asarray(values[mask])
+    result = dict(attribute=attribute, count=int(mask.sum()))
+
+    if categories is None:
+        distinct = get_distinct_values(values, buckets)
+        if distinct is not None:
+            # Few distinct values: count each value, as for categorical attributes
+            categories = to_json_floats(distinct).tolist()
+            codes = np.searchsorted(distinct, selected)
+            codes[np.isnan(selected)] = -1
+            selected = codes
+
+    if categories is not None:
+        null = selected < 0
+        groups = selected[~null]
+        counts = np.bincount(groups, minlength=len(categories))
+        result.update(kind='categorical', keys=categories, counts=counts.tolist())
+    else:
+        null = np.isnan(selected)
+        vmin, vmax = float(np.nanmin(values)), float(np.nanmax(values))
+        if scale == 'log':
+            if vmin <= 0:
+                raise ValueError(f'Attribute "{attribute}" has values <= 0 and cannot use a log scale.')
+            low, high = np.log10(vmin), np.log10(vmax)
+            edges = np.logspace(low, high, buckets + 1)
+            position = np.log10(selected[~null])
+        else:
+            low, high = vmin, vmax
+            edges = np.linspace(low, high, buckets + 1)
+            position = selected[~null]
+        width = (high - low) / buckets or 1
+        # The maximum value falls in the last bucket
+        groups = np.clip(((position - low) / width).astype(np.int64), 0, buckets - 1)
+        counts = np.bincount(groups, minlength=buckets)
+        result.update(kind='numeric', edges=edges.tolist(), counts=counts.tolist())
+
+    result['null_count'] = int(null.sum())
+    if bucket_ids:
+        ids = attributes.ids[mask][~null]
+        result['id_ranges'] = get_id_ranges(ids, groups, len(result['counts']))
+    return result
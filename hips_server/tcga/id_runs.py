@@ -0,0 +1,103 @@
+import numpy as np
+
+
+# Run-length encoded sets of cell ids, a compact bitmap for the mostly consecutive ids
+# of an image's cells: {"base": first id, "runs": [skip, take, skip, take, ...], "count": ids}.
+# Decoding starts at id = base; each pair skips `skip` ids and then takes the next `take` ids.
+
+
+def encode_id_runs(ids):
+    """Encode sorted, unique ids."""
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(ids):
+        return dict(base=0, runs=[], count=0)
+    starts = np.flatnonzero(np.diff(ids, prepend=ids[0] - 2) != 1)
+    takes = np.diff(starts, append=len(ids))
+    run_starts = ids[starts]
+    # ids skipped since the end of the previous run, and since base for the first run
+    skips = run_starts - np.concatenate([[ids[0]], run_starts[:-1] + takes[:-1]])
+    return dict(
+        base=int(ids[0]),
+        runs=np.stack([skips, takes], axis=1).ravel().tolist(),
+        count=len(ids),
+    )
+
+
+def decode_id_runs(base, runs):
+    runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+    if not len(runs):
+        return np.empty(0, dtype=np.int64)
+    skips, takes = runs[:, 0], runs[:, 1]
+    run_starts = base + np.cumsum(skips) + np.concatenate([[0], np.cumsum(takes)[:-1]])
+    # Each id is the start of its run plus its position in the run
+    run_of_id = np.repeat(np.arange(len(runs)), takes)
+    position = np.arange(takes.sum()) - np.repeat(np.cumsum(takes) - takes, takes)
+    return run_starts[run_of_id] + position
+
+
+def empty_id_runs():
+    return dict(base=0, runs=[], count=0)
+
+
+class IdRunSet:
+    """
+    A set of cell ids held as id runs, with set operations that work on the runs
+    as half-open [start, stop) intervals instead of on every id.
+    """
+
+    def __init__(self, base=0, runs=()):
+        runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+        skips, takes = runs[:, 0], runs[:, 1]
+        self.base = base
+        self.runs = runs.ravel()
+        self.starts = base + np.cumsum(skips) + np.concatenate([[0], np.cumsum(takes)[:-1]])
+        self.stops = self.starts + takes
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value.get('base', 0), value.get('runs', []))
+
+    def as_dict(self):
+        return dict(base=int(self.base), runs=self.runs.tolist(), count=len(self))
+
+    def __len__(self):
+        return int((self.stops - self.starts).sum())
+
+    def ids(self):
+        return decode_id_runs(self.base, self.runs)
+
+    def __getitem__(self, positions):
+        """
+        Ids at a slice of positions in the sorted set, as a list, decoding only those ids;
+        lets paginators page through the set without decoding all of it.
+        """
+        start, stop, step = positions.indices(len(self))
+        positions = np.arange(start, stop, step, dtype=np.int64)
+        run_ends = np.cumsum(self.stops - self.starts)
+        run = np.searchsorted(run_ends, positions, side='right')
+        run_offsets = run_ends - (self.stops - self.starts)
+        return (self.starts[run] + positions - run_offsets[run]).tolist()
+
+    def contains(self, ids):
+        """Boolean mask of the given ids that are in the set."""
+        ids = np.asarray(ids, dtype=np.int64)
+        run = np.searchsorted(self.stops, ids, side='right')
+        found = run < len(self.starts)
+        found[found] = self.starts[run[found]] <= ids[found]
+        return found
+
+    def intersect(self, ids):
+        """The given ids that are in the set."""
+        ids = np.asarray(ids, dtype=np.int64)
+        return ids[self.contains(ids)]
+
+    def in_range(self, start, stop):
+        """Ids of the set with start <= id < stop, as a new IdRunSet."""
+        starts = np.clip(self.starts, start, stop)
+        stops = np.clip(self.stops, start, stop)
+        keep = stops > starts
+        starts, stops = starts[keep], stops[keep]
+        if not len(starts):
+            return IdRunSet()
+        skips = starts - np.concatenate([[starts[0]], stops[:-1]])
+        return IdRunSet(int(starts[0]), np.stack([skips, stops - starts], axis=1).ravel())
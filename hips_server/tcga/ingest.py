@@ -0,0 +1,212 @@
+import hashlib
+import numpy as np
+
+from collections import deque
+from datetime import datetime
+from django.db import connection, transaction
+
+from tcga.models import Image, Cell, ROIManifest, ColumnStats, INDEXED_FIELDS, bump_data_version
+from tcga.feature_store import FeatureStore, FeatureStoreWriter, slice_columns, to_json_floats
+from tcga.spatial_index import SpatialIndex, build_spatial_index
+from tcga.column_stats import update_column_stats
+from tcga.read_vectors import get_roi_vector_files, prepare_roi_files
+
+
+BATCH_SIZE = 10000
+CHECKSUM_CHUNK_SIZE = 1 << 20
+CELL_FIELDS = ['x', 'y', 'width', 'height', 'orientation']
+
+
+def imap_bounded(pool, func, items, window):
+    # Like pool.imap, but keeps at most `window` results in flight so that
+    # fast readers cannot run arbitrarily far ahead of the database writer
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def get_roi_signature(vector_files):
+    # Cheap change detection: total size and latest modification time of the ROI files
+    stats = [f.stat() for f in vector_files]
+    return sum(st.st_size for st in stats), max(st.st_mtime for st in stats)
+
+
+def get_roi_checksum(vector_files):
+    digest = hashlib.sha256()
+    for f in vector_files:
+        with open(f, 'rb') as stream:
+            for chunk in iter(lambda: stream.read(CHECKSUM_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_indexed_values(columns, rows):
+    # Values of the INDEXED_FIELDS columns as lists of floats, with None for null
+    values = []
+    for name in INDEXED_FIELDS:
+        column = to_json_floats(columns[name][rows])
+        values.append(np.where(np.isnan(column), None, column).tolist())
+    return values
+
+
+def create_roi_cells(image, writer, prepared_rois, batch_size=BATCH_SIZE):
+    """
+    Save Cells and their feature vectors for the prepared ROIs of one ROI file pair
+    (see read_vectors.prepare_roi), in fixed-size batches. Returns the new cell ids.
+    """
+    cell_ids = []
+    for roi in prepared_rois:
+        fields = roi['fields']
+        codes, classes = roi['columns']['Classif.StandardClass']
+        classification = np.array([*classes, ''], dtype=object)[codes]
+        for batch_start in range(0, roi['count'], batch_size):
+            batch = slice(batch_start, batch_start + batch_size)
+            field_names = [*CELL_FIELDS, *INDEXED_FIELDS.values()]
+            cells = Cell.objects.bulk_create([
+                Cell(image=image, classification=c, **dict(zip(field_names, values)))
+                for c, *values in zip(
+                    classification[batch],
+                    *[fields[name][batch].tolist() for name in CELL_FIELDS],
+                    *get_indexed_values(roi['columns'], batch),
+                )
+            ])
+            batch_ids = [cell.id for cell in cells]
+            writer.append_columns(batch_ids, slice_columns(roi['columns'], batch))
+            cell_ids += batch_ids
+    return cell_ids
+
+
+def delete_roi_cells(image, writer, manifest):
+    if manifest.cell_count:
+        cell_range = (manifest.first_cell_id, manifest.last_cell_id)
+        Cell.objects.filter(image=image, id__range=cell_range).delete()
+        # Feature rows are only removed once the deletion commits, so a rollback keeps them;
+        # rows left by a crash in between are dropped by the next run's remove_id_ranges(keep=True)
+        transaction.on_commit(lambda: writer.remove_id_ranges([cell_range]))
+
+
+def mark_rebuild_pending(image):
+    # update() rather than save(), to stay within the caller's transaction without signals
+    Image.objects.filter(id=image.id).update(rebuild_pending=True)
+
+
+def update_case(image, case_folder, pool=None, workers=1, batch_size=BATCH_SIZE):
+    """
+    Bring the Cells of an Image up to date with the ROI files in its case folder.
+
+    Only ROIs whose files are new or changed since the last run are (re)inserted,
+    each in its own transaction together with its ROIManifest,
+    so an interrupted run resumes after the last committed ROI.
+    ROI files are read in a process pool if one is given.
+    """
+    start = datetime.now()
+    manifests = {m.name: m for m in ROIManifest.objects.filter(image=image)}
+    with FeatureStoreWriter(image.id) as writer:
+        if not len(manifests):
+            # Cells without manifests cannot be matched to ROI files; start over
+            with transaction.atomic():
+                Cell.objects.filter(image=image).delete()
+                mark_rebuild_pending(image)
+        # Drop feature rows written by a transaction that did not commit
+        writer.remove_id_ranges([
+            (m.first_cell_id, m.last_cell_id)
+            for m in manifests.values() if m.cell_count
+        ], keep=True)
+
+        all_vector_files = get_roi_vector_files(case_folder)
+        changed = []
+        for vector_files in all_vector_files:
+            name = vector_files[0].stem
+            manifest = manifests.pop(name, None)
+            size, mtime = get_roi_signature(vector_files)
+            if manifest and manifest.size == size and manifest.mtime == mtime:
+                continue
+            checksum = get_roi_checksum(vector_files)
+            if manifest and manifest.checksum == checksum:
+                manifest.size, manifest.mtime = size, mtime
+                manifest.save()
+                continue
+            signature = dict(size=size, mtime=mtime, checksum=checksum)
+            changed.append((name, vector_files, signature, manifest))
+
+        # ROI files that no longer exist
+        for manifest in manifests.values():
+            with transaction.atomic():
+                delete_roi_cells(image, writer, manifest)
+                manifest.delete()
+                mark_rebuild_pending(image)
+
+        print(f'{len(changed)} of {len(all_vector_files)} ROIs are new or changed.')
+        changed_files = [vector_files for _, vector_files, _, _ in changed]
+        if pool is None:
+            results = map(prepare_roi_files, changed_files)
+        else:
+            results = imap_bounded(pool, prepare_roi_files, changed_files, workers * 2)
+
+        count = 0
+        for (name, _, signature, manifest), prepared_rois in zip(changed, results):
+            with transaction.atomic():
+                if manifest:
+                    delete_roi_cells(image, writer, manifest)
+                cell_ids = create_roi_cells(image, writer, prepared_rois, batch_size)
+                ROIManifest.objects.update_or_create(
+                    image=image,
+                    name=name,
+                    defaults=dict(
+                        **signature,
+                        first_cell_id=min(cell_ids, default=None),
+                        last_cell_id=max(cell_ids, default=None),
+                        cell_count=len(cell_ids),
+                    ),
+                )
+                mark_rebuild_pending(image)
+            writer.flush()
+            count += len(cell_ids)
+
+    # Pending also when an earlier, interrupted run committed ROIs but did not get this far
+    image.refresh_from_db(fields=['rebuild_pending'])
+    if image.rebuild_pending or not SpatialIndex(image.id).exists():
+        build_spatial_index(image.id)
+    if image.rebuild_pending or not ColumnStats.objects.filter(image=image).exists():
+        update_column_stats(image)
+    if image.rebuild_pending:
+        # Cached responses with cells of the image are stale
+        bump_data_version(f'image:{image.id}')
+        Image.objects.filter(id=image.id).update(rebuild_pending=False)
+
+    seconds = (datetime.now() - start).total_seconds()
+    rate = count / seconds if seconds else count
+    print(f'Created {count} Cells in {seconds} seconds ({rate:.0f} rows/sec).')
+    return count
+
+
+def backfill_indexed_columns(image, batch_size=BATCH_SIZE):
+    """
+    Copy the INDEXED_FIELDS columns of the FeatureStore of an Image into the indexed Cell fields,
+    for cells ingested before those fields existed. Each batch of cells is updated in its own transaction.
+    """
+    start = datetime.now()
+    store = FeatureStore(image.id)
+    if not store.exists():
+        print(f'Image {image.name} has no feature store.')
+        return 0
+    ids = store.ids
+    columns = {name: store.values(name) for name in INDEXED_FIELDS}
+    # One parameterized UPDATE per cell, sent in batches; bulk_update is much slower here
+    quote = connection.ops.quote_name
+    assignments = ', '.join(
+        f'{quote(Cell._meta.get_field(field).column)} = %s' for field in INDEXED_FIELDS.values()
+    )
+    sql = f'UPDATE {quote(Cell._meta.db_table)} SET {assignments} WHERE id = %s'
+    for batch_start in range(0, len(ids), batch_size):
+        batch = slice(batch_start, batch_start + batch_size)
+        rows = zip(*get_indexed_values(columns, batch), ids[batch].tolist())
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, list(rows))
+    seconds = (datetime.now() - start).total_seconds()
+    print(f'Updated {len(ids)} Cells of {image.name} in {seconds} seconds.')
+    return len(ids)
@@ -1,11 +1,12 @@
 from django.core.management.base import BaseCommand
-from tcga.umap import create_transform_result
+from tcga.umap import create_transform_result, SAMPLE_MODES, APPLY_CHUNK_SIZE
 
 # Example Usage
 # python manage.py apply_transform 1
 # --cases TCGA-3C-AALI-01Z-00-DX1
 # --classes CancerEpithelium TILsCell ActiveTILsCell
-# --sample_size 500
+# --sample_size 500 --sample_mode stratified --seed 1
+# --workers 4 --chunk_size 50000
 
 class Command(BaseCommand):
     requires_migrations_checks = True
@@ -15,6 +16,10 @@ class Command(BaseCommand):
         parser.add_argument('--cases', nargs='*', type=str)
         parser.add_argument('--classes', nargs='*', type=str)
         parser.add_argument('--sample_size', type=int)
+        parser.add_argument('--sample_mode', type=str, choices=SAMPLE_MODES, default='first')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--chunk_size', type=int, default=APPLY_CHUNK_SIZE)
 
     def handle(self, *args, **kwargs):
         create_transform_result(**kwargs)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from tcga.models import Image
+from tcga.ingest import BATCH_SIZE, backfill_indexed_columns
+
+# Example Usage
+# python manage.py backfill_indexed_columns --cases TCGA-3C-AALI-01Z-00-DX1 --batch_size 5000
+
+class Command(BaseCommand):
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cases', nargs='*', type=str)
+        parser.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **kwargs):
+        cases = kwargs.get('cases')
+        images = Image.objects.all()
+        if cases:
+            images = images.filter(name__in=cases)
+        for image in images.order_by('id'):
+            backfill_indexed_columns(image, kwargs.get('batch_size') or BATCH_SIZE)
@@ -16,5 +16,5 @@ class Command(BaseCommand):
             print('\t', 'ID:', transform.id)
             print('\t', 'Created', transform.created)
             print('\t', UMAPResult.objects.filter(transform=transform).count(), 'results')
-            print('\t', transform.fitted_cells.count(), 'fitted cells')
+            print('\t', transform.fitted_ids['count'], 'fitted cells')
             print('\t', len(transform.column_names), 'included columns')
@@ -1,20 +1,18 @@
-import math
-import girder_client
-from datetime import datetime
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management.base import BaseCommand
-from tcga.models import Image, Cell
-from tcga.read_vectors import get_case_vector
+from tcga.models import Image
+from tcga.ingest import update_case
+from tcga.download import CaseDownloader, DOWNLOAD_WORKERS
 from tcga.constants import (
     SAMPLE_DATA_SERVER,
     SAMPLE_DATA_COLLECTION,
     DOWNLOADS_FOLDER,
-    IMAGE_SUFFIXES,
-    VECTOR_COLUMNS,
 )
 
 # Example Usage
-# python manage.py populate --cases TCGA-3C-AALI-01Z-00-DX1 --no_cache
+# python manage.py populate --cases TCGA-3C-AALI-01Z-00-DX1 --no_cache --workers 4
 
 class Command(BaseCommand):
     requires_migrations_checks = True
@@ -22,97 +20,70 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--no-cache', action='store_true')
         parser.add_argument('--cases', nargs='*', type=str)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--reload', action='store_true')
+        parser.add_argument('--download_workers', type=int, default=DOWNLOAD_WORKERS)
+        parser.add_argument('--api_url', type=str, default=SAMPLE_DATA_SERVER)
+        parser.add_argument('--collection_id', type=str, default=SAMPLE_DATA_COLLECTION)
 
     def handle(self, *args, **kwargs):
         no_cache = kwargs.get('no_cache')
+        reload = kwargs.get('reload')
         cases = kwargs.get('cases') or []
+        workers = kwargs.get('workers') or 1
+        # ROI files are read and prepared in worker processes;
+        # this process remains the single database writer
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.get_context('spawn').Pool(workers)
+        try:
+            self.populate(
+                cases, no_cache, reload, pool, workers,
+                kwargs.get('api_url'),
+                kwargs.get('collection_id'),
+                kwargs.get('download_workers'),
+            )
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def populate(self, cases, no_cache, reload, pool, workers, api_url, collection_id, download_workers):
         print(f'Populating cases {cases}...')
         print('Note: Initial data downloads may take a while...')
-        client = girder_client.GirderClient(apiUrl=SAMPLE_DATA_SERVER)
-        for folder in client.listFolder(SAMPLE_DATA_COLLECTION):
-            case_name = folder.get('name')
-            if case_name in cases or (
-                len(cases) == 0 and case_name != 'test'
-            ):
-                # Delete existing objects from database
-                # (Image deletion cascades to related Cells)
-                Image.objects.filter(name=case_name).delete()
-
-                # Find image item
-                folder_id = folder.get('_id')
-                image_matches = [
-                    item for item in client.listItem(folder_id)
-                    if any(
-                        item.get('name', '').endswith(suffix)
-                        for suffix in IMAGE_SUFFIXES
-                    )
-                ]
-                if not len(image_matches):
-                    print(f'ERROR: Could not find an item in {case_name} that ends with an image suffix. Skipping case.')
-                    continue
-                image = image_matches[0]
+        with CaseDownloader(
+            api_url, download_workers, overwrite=no_cache
+        ) as downloader, ThreadPoolExecutor(max_workers=1) as prefetch:
+            case_list = downloader.list_cases(collection_id, cases)
 
-                # Save Image to database
-                image_id = image.get('_id')
-                image_object = Image.objects.create(
-                    name=case_name,
-                    tile_url=f'{SAMPLE_DATA_SERVER}/item/{image_id}/tiles'
-                )
-                print(f'\nCreated Image object for {case_name}.')
+            def start_download(case):
+                case_folder = DOWNLOADS_FOLDER / case['name']
+                print(f'Downloading vector data for {case["name"]} to {case_folder}.')
+                return prefetch.submit(downloader.download_case, case, case_folder)
 
-                # Download data
+            download = start_download(case_list[0]) if len(case_list) else None
+            for i, case in enumerate(case_list):
+                case_name = case['name']
                 case_folder = DOWNLOADS_FOLDER / case_name
-                print(f'Downloading vector data for {case_name} to {case_folder}.')
-                start = datetime.now()
-                for data_folder in client.listFolder(folder_id):
-                    # Find nucleiMeta and nucleiProps folders
-                    data_folder_name = data_folder.get('name')
-                    data_folder_path =  case_folder / data_folder_name
-                    if 'nuclei' in data_folder_name and (
-                        not data_folder_path.exists() or no_cache
-                    ):
-                        client.downloadFolderRecursive(
-                            data_folder.get('_id'), data_folder_path, sync=True
-                        )
-                seconds = (datetime.now() - start).total_seconds()
-                print(f'Completed download in {seconds} seconds.')
+                download.result()
+                # Download the next case while this one is read and saved
+                if i + 1 < len(case_list):
+                    download = start_download(case_list[i + 1])
 
-                # Read case vector
-                print(f'Reading vector data for {case_name}.')
-                start = datetime.now()
-                vector = get_case_vector(case_folder)
-                # Ensure correct column ordering for vector field
-                vector = vector[VECTOR_COLUMNS]
+                if reload:
+                    # Delete existing objects from database
+                    # (Image deletion cascades to related Cells and ROIManifests)
+                    Image.objects.filter(name=case_name).delete()
 
-                def _clean(v):
-                    # ints/floats stay numeric; strings pass through; NaN/Inf -> None (JSON null)
-                    if isinstance(v, float):
-                        if math.isnan(v) or math.isinf(v):
-                            return None
-                        return int(v) if v.is_integer() else v
-                    return v
+                # Save Image to database, reusing an existing one
+                image_object, created = Image.objects.update_or_create(
+                    name=case_name,
+                    defaults=dict(tile_url=f'{api_url}/item/{case["image_item_id"]}/tiles'),
+                )
+                print(f'\n{"Created" if created else "Updating"} Image object for {case_name}.')
 
-                # Save Cells to database
-                cell_data = []
-                for roi_name, roi_group in list(vector.groupby('roiname')):
-                    components = roi_name.split('_')[2:]
-                    roi = {}
-                    for component in components:
-                        key, value = component.split('-')
-                        roi[key] = int(value)
-                    for index, row in roi_group.iterrows():
-                        cell_data.append(Cell(
-                            image=image_object,
-                            x=row['Unconstrained.Identifier.CentroidX'] * 2 + roi.get('left'),
-                            y=row['Unconstrained.Identifier.CentroidY'] * 2 + roi.get('top'),
-                            width=row['Size.MinorAxisLength'] * 2,
-                            height=row['Size.MajorAxisLength'] * 2,
-                            orientation=0 - row['Orientation.Orientation'],
-                            classification=row['Classif.StandardClass'],
-                            vector=[_clean(v) for v in row],
-                        ))
-                cells = Cell.objects.bulk_create(cell_data)
-                seconds = (datetime.now() - start).total_seconds()
-                print(f'Created {len(cells)} Cells in {seconds} seconds.')
+                # Read new or changed ROI vectors and save Cells
+                print(f'Reading vector data for {case_name}.')
+                update_case(image_object, case_folder, pool, workers)
 
         print('Done.')
@@ -0,0 +1,342 @@
+import atexit
+import ipaddress
+import json
+import os
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import Http404, HttpResponse
+
+from tcga.constants import METRICS_FOLDER
+from tcga.profiler import SamplingProfiler
+
+
+# Per-request instrumentation. MetricsMiddleware times each request and collects what the
+# code run for it records in the RequestMetrics of the current context: database queries
+# (through an execute wrapper on every connection) and named timings such as JSON rendering
+# (see record_timing). They are sent back in a Server-Timing header and aggregated per
+# endpoint. Each server process keeps its own aggregates and writes them to METRICS_FOLDER
+# every FLUSH_INTERVAL seconds, and /metrics serves the sum over all running processes
+# in the Prometheus text format.
+
+# Upper bounds in seconds of the buckets of the request duration histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FLUSH_INTERVAL = 5
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        # Name to seconds, in the order first recorded
+        self.timings = {}
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+def record_timing(name, seconds):
+    """Add to a named timing of the current request, if any."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.timings[name] = metrics.timings.get(name, 0) + seconds
+
+
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - start)
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_queries += 1
+        metrics.db_seconds += time.perf_counter() - start
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Wrappers outlive reconnections of the same connection object
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def new_endpoint_stats():
+    return dict(
+        count=0,
+        seconds=0.0,
+        buckets=[0] * (len(DURATION_BUCKETS) + 1),
+        statuses={},
+        db_queries=0,
+        db_seconds=0.0,
+        response_bytes=0,
+        timings={},
+    )
+
+
+def merge_endpoint_stats(total, stats):
+    for name in ['count', 'seconds', 'db_queries', 'db_seconds', 'response_bytes']:
+        total[name] += stats[name]
+    total['buckets'] = [a + b for a, b in zip(total['buckets'], stats['buckets'])]
+    for group in ['statuses', 'timings']:
+        for key, value in stats[group].items():
+            total[group][key] = total[group].get(key, 0) + value
+
+
+class MetricsRegistry:
+    """Aggregated request metrics of this process, by method and endpoint."""
+
+    def __init__(self, folder=METRICS_FOLDER):
+        self.folder = folder
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        self.flush_thread = None
+
+    def observe(self, method, endpoint, status, seconds, metrics, response_bytes):
+        with self.lock:
+            stats = self.endpoints.setdefault((method, endpoint), new_endpoint_stats())
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['buckets'][bisect_left(DURATION_BUCKETS, seconds)] += 1
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+            stats['db_queries'] += metrics.db_queries
+            stats['db_seconds'] += metrics.db_seconds
+            stats['response_bytes'] += response_bytes
+            for name, value in metrics.timings.items():
+                stats['timings'][name] = stats['timings'].get(name, 0) + value
+            if self.flush_thread is None:
+                # Aggregates are written out by a thread of their own, not in the request path
+                self.flush_thread = threading.Thread(target=self.run_flush, name='metrics-flush', daemon=True)
+                self.flush_thread.start()
+                atexit.register(self.flush)
+
+    def run_flush(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f'Could not write request metrics: {e}')
+
+    def snapshot(self):
+        with self.lock:
+            return [
+                dict(method=method, endpoint=endpoint, **json.loads(json.dumps(stats)))
+                for (method, endpoint), stats in self.endpoints.items()
+            ]
+
+    def flush(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        path = self.folder / f'{os.getpid()}.json'
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        tmp_path.replace(path)
+
+    def collect(self):
+        """Aggregates of this process and of the other running server processes."""
+        snapshots = [self.snapshot()]
+        if self.folder.exists():
+            for path in self.folder.glob('*.json'):
+                # Files are named by process id; skip anything else
+                if not path.stem.isdigit():
+                    continue
+                pid = int(path.stem)
+                if pid == os.getpid():
+                    continue
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    # Counters of stopped processes are dropped, like on a restart
+                    path.unlink(missing_ok=True)
+                    continue
+                except PermissionError:
+                    pass
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (FileNotFoundError, ValueError):
+                    continue
+        totals = {}
+        for snapshot in snapshots:
+            for stats in snapshot:
+                key = (stats['method'], stats['endpoint'])
+                merge_endpoint_stats(totals.setdefault(key, new_endpoint_stats()), stats)
+        return totals
+
+
+registry = MetricsRegistry()
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(**labels):
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + '}'
+
+
+def format_prometheus(totals):
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(f'{name}{format_labels(**labels)} {value}' for labels, value in samples)
+
+    endpoints = sorted(totals.items())
+    lines.append(
+        '# HELP hips_request_duration_seconds Time to respond to requests, '
+        'until the first byte for streamed responses.'
+    )
+    lines.append('# TYPE hips_request_duration_seconds histogram')
+    for (method, endpoint), stats in endpoints:
+        cumulative = 0
+        for bound, count in zip([*DURATION_BUCKETS, '+Inf'], stats['buckets']):
+            cumulative += count
+            labels = format_labels(method=method, endpoint=endpoint, le=bound)
+            lines.append(f'hips_request_duration_seconds_bucket{labels} {cumulative}')
+        labels = format_labels(method=method, endpoint=endpoint)
+        lines.append(f'hips_request_duration_seconds_sum{labels} {stats["seconds"]}')
+        lines.append(f'hips_request_duration_seconds_count{labels} {stats["count"]}')
+
+    metric('hips_requests_total', 'counter', 'Requests by response status.', [
+        (dict(method=method, endpoint=endpoint, status=status), count)
+        for (method, endpoint), stats in endpoints
+        for status, count in sorted(stats['statuses'].items())
+    ])
+    for name, key, description in [
+        ('hips_db_queries_total', 'db_queries', 'Database queries run for requests.'),
+        ('hips_db_query_seconds_total', 'db_seconds', 'Time spent in database queries run for requests.'),
+        ('hips_response_bytes_total', 'response_bytes', 'Bytes of response bodies, as sent.'),
+    ]:
+        metric(name, 'counter', description, [
+            (dict(method=method, endpoint=endpoint), stats[key])
+            for (method, endpoint), stats in endpoints
+        ])
+    metric('hips_request_phase_seconds_total', 'counter', 'Time spent in named phases of requests.', [
+        (dict(method=method, endpoint=endpoint, phase=phase), seconds)
+        for (method, endpoint), stats in endpoints
+        for phase, seconds in sorted(stats['timings'].items())
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+def is_metrics_client(address):
+    # METRICS_ALLOWED_IPS holds addresses and networks, e.g. 172.16.0.0/12 for docker networks
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(allowed.strip(), strict=False)
+        for allowed in settings.METRICS_ALLOWED_IPS if allowed.strip()
+    )
+
+
+def metrics_view(request):
+    if not is_metrics_client(request.META.get('REMOTE_ADDR', '')):
+        raise Http404()
+    return HttpResponse(format_prometheus(registry.collect()), content_type=CONTENT_TYPE)
+
+
+def get_endpoint(request):
+    # The URL pattern rather than the path, so that e.g. all images share one endpoint
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else 'unmatched'
+
+
+def get_response_bytes(response):
+    if response.has_header('Content-Length'):
+        return int(response['Content-Length'])
+    return 0 if response.streaming else len(response.content)
+
+
+def server_timing(metrics, seconds):
+    entries = [f'db;dur={metrics.db_seconds * 1000:.2f};desc="{metrics.db_queries} queries"']
+    entries.extend(f'{name};dur={value * 1000:.2f}' for name, value in metrics.timings.items())
+    entries.append(f'total;dur={seconds * 1000:.2f}')
+    return ', '.join(entries)
+
+
+class MetricsMiddleware:
+    """
+    Records the duration, database queries, response size and named timings of each request
+    in the metrics registry and in a Server-Timing header. With PROFILE_SLOW_REQUESTS_MS set,
+    requests are also sampled by the profiler and the stacks of those slower than that written out.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.profile_threshold = getattr(settings, 'PROFILE_SLOW_REQUESTS_MS', None)
+        self.profiler = None
+        if self.profile_threshold is not None:
+            self.profiler = SamplingProfiler(getattr(settings, 'PROFILE_INTERVAL_MS', 5) / 1000)
+        self.timing_origins = ', '.join(getattr(settings, 'CORS_ALLOWED_ORIGINS', []))
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics, token, profile = self.begin()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, profile)
+
+    async def __acall__(self, request):
+        metrics, token, profile = self.begin()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, profile)
+
+    def begin(self):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        profile = self.profiler.start() if self.profiler else None
+        return metrics, token, profile
+
+    def finish(self, request, response, metrics, profile):
+        seconds = metrics.elapsed()
+        endpoint = get_endpoint(request)
+        registry.observe(
+            request.method, endpoint, response.status_code, seconds, metrics,
+            get_response_bytes(response),
+        )
+        response['Server-Timing'] = server_timing(metrics, seconds)
+        if self.timing_origins:
+            # Lets the viewer read Server-Timing from another origin
+            response['Timing-Allow-Origin'] = self.timing_origins
+        if profile is not None:
+            self.profiler.stop(profile)
+            if seconds * 1000 >= self.profile_threshold:
+                path = profile.write(f'{request.method} {endpoint}', seconds)
+                print(f'Slow request {request.method} {request.get_full_path()} ({seconds:.3f}s), profile in {path}.')
+        return response
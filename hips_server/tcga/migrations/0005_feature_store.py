@@ -0,0 +1,62 @@
+import pandas
+from django.db import migrations
+
+from tcga.constants import VECTOR_COLUMNS
+from tcga.feature_store import FeatureStore, FeatureStoreWriter
+
+CHUNK_SIZE = 10000
+
+
+def forwards(apps, schema_editor):
+    # Move every JSON vector into the columnar feature store of its image
+    Image = apps.get_model("tcga", "Image")
+    Cell = apps.get_model("tcga", "Cell")
+    for image in Image.objects.all():
+        FeatureStore(image.id).delete()
+        with FeatureStoreWriter(image.id) as writer:
+            cells = Cell.objects.filter(image=image).order_by("id").values_list("id", "vector")
+            chunk = []
+            for row in cells.iterator(chunk_size=CHUNK_SIZE):
+                chunk.append(row)
+                if len(chunk) == CHUNK_SIZE:
+                    write_chunk(writer, chunk)
+                    chunk = []
+            if len(chunk):
+                write_chunk(writer, chunk)
+
+
+def write_chunk(writer, chunk):
+    ids = [cell_id for cell_id, _ in chunk]
+    vectors = [(vector or []) + [None] * (len(VECTOR_COLUMNS) - len(vector or [])) for _, vector in chunk]
+    writer.append(ids, pandas.DataFrame(vectors, columns=VECTOR_COLUMNS))
+
+
+def backwards(apps, schema_editor):
+    Image = apps.get_model("tcga", "Image")
+    Cell = apps.get_model("tcga", "Cell")
+    for image in Image.objects.all():
+        store = FeatureStore(image.id)
+        if not store.exists():
+            continue
+        for start in range(0, len(store), CHUNK_SIZE):
+            rows = slice(start, start + CHUNK_SIZE)
+            cells = [
+                Cell(id=int(cell_id), vector=vector)
+                for cell_id, vector in zip(store.ids[rows], store.vectors(rows, VECTOR_COLUMNS))
+            ]
+            Cell.objects.bulk_update(cells, ["vector"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcga', '0004_remove_cell_vector_text'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(
+            model_name='cell',
+            name='vector',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcga', '0005_feature_store'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ROIManifest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('first_cell_id', models.BigIntegerField(null=True)),
+                ('last_cell_id', models.BigIntegerField(null=True)),
+                ('cell_count', models.IntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tcga.image')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('image', 'name'), name='unique_image_roi')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcga', '0006_roi_manifest'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'id'], name='cell_image_id_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcga', '0007_cell_image_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ColumnStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('kind', models.CharField(max_length=20)),
+                ('count', models.BigIntegerField(default=0)),
+                ('null_count', models.BigIntegerField(default=0)),
+                ('minimum', models.FloatField(null=True)),
+                ('maximum', models.FloatField(null=True)),
+                ('mean', models.FloatField(null=True)),
+                ('std', models.FloatField(null=True)),
+                ('quantiles', models.JSONField(default=dict)),
+                ('categories', models.JSONField(default=dict)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tcga.image')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('image', 'name'), name='unique_image_column')],
+            },
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:05
+
+import json
+import numpy as np
+
+from django.db import migrations, models
+from tcga.result_store import ResultPoints, save_result_points
+
+
+def forwards(apps, schema_editor):
+    # Move the JSON scatterplot data of existing results into result point files
+    UMAPResult = apps.get_model("tcga", "UMAPResult")
+    for result in UMAPResult.objects.all():
+        points = result.scatterplot_data
+        if isinstance(points, str):
+            points = json.loads(points)
+        ids = np.array([p["id"] for p in points], dtype=np.int64)
+        x = np.array([p["x"] for p in points], dtype=np.float32)
+        y = np.array([p["y"] for p in points], dtype=np.float32)
+        save_result_points(result.id, ids, x, y)
+        result.cell_count = len(ids)
+        result.save(update_fields=["cell_count"])
+
+
+def backwards(apps, schema_editor):
+    UMAPResult = apps.get_model("tcga", "UMAPResult")
+    for result in UMAPResult.objects.all():
+        points = ResultPoints(result.id)
+        result.scatterplot_data = json.dumps([
+            dict(x=float(x), y=float(y), id=int(i))
+            for i, x, y in zip(points.ids, points.x, points.y)
+        ])
+        result.save(update_fields=["scatterplot_data"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcga', '0008_column_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='umapresult',
+            name='cell_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='umapresult',
+            name='scatterplot_data',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(
+            model_name='umapresult',
+            name='scatterplot_data',
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:30
+
+import tcga.id_runs
+from django.db import migrations, models
+from tcga.id_runs import IdRunSet, encode_id_runs
+
+
+def forwards(apps, schema_editor):
+    # Encode the cells of the many-to-many tables as id runs
+    UMAPTransform = apps.get_model("tcga", "UMAPTransform")
+    UMAPResult = apps.get_model("tcga", "UMAPResult")
+    for transform in UMAPTransform.objects.all():
+        ids = transform.fitted_cells.order_by("id").values_list("id", flat=True)
+        transform.fitted_ids = encode_id_runs(list(ids))
+        transform.save(update_fields=["fitted_ids"])
+    for result in UMAPResult.objects.all():
+        ids = result.transformed_cells.order_by("id").values_list("id", flat=True)
+        result.transformed_ids = encode_id_runs(list(ids))
+        result.save(update_fields=["transformed_ids"])
+
+
+def backwards(apps, schema_editor):
+    Cell = apps.get_model("tcga", "Cell")
+    UMAPTransform = apps.get_model("tcga", "UMAPTransform")
+    UMAPResult = apps.get_model("tcga", "UMAPResult")
+    for transform in UMAPTransform.objects.all():
+        ids = IdRunSet.from_dict(transform.fitted_ids).ids().tolist()
+        transform.fitted_cells.set(Cell.objects.filter(id__in=ids))
+    for result in UMAPResult.objects.all():
+        ids = IdRunSet.from_dict(result.transformed_ids).ids().tolist()
+        result.transformed_cells.set(Cell.objects.filter(id__in=ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcga', '0009_umap_result_points'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='umapresult',
+            name='transformed_ids',
+            field=models.JSONField(default=tcga.id_runs.empty_id_runs),
+        ),
+        migrations.AddField(
+            model_name='umaptransform',
+            name='fitted_ids',
+            field=models.JSONField(default=tcga.id_runs.empty_id_runs),
+        ),
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(
+            model_name='umapresult',
+            name='transformed_cells',
+        ),
+        migrations.RemoveField(
+            model_name='umaptransform',
+            name='fitted_cells',
+        ),
+    ]
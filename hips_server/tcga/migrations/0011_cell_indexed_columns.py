@@ -0,0 +1,116 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcga', '0010_id_run_membership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cell',
+            name='classifprobab_activestromalcellnos',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='classifprobab_activetilscell',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='classifprobab_background',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='classifprobab_cancerepithelium',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='classifprobab_normalepithelium',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='classifprobab_othercell',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='classifprobab_stromalcellnos',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='classifprobab_tilscell',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='classifprobab_unknownorambiguouscell',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='shape_circularity',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='size_area',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classification'], name='cell_image_class_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'size_area'], name='tcga_cell_image_i_c663a7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'shape_circularity'], name='tcga_cell_image_i_7be017_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classifprobab_cancerepithelium'], name='tcga_cell_image_i_ea085c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classifprobab_stromalcellnos'], name='tcga_cell_image_i_490423_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classifprobab_activestromalcellnos'], name='tcga_cell_image_i_3c0ec5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classifprobab_tilscell'], name='tcga_cell_image_i_5e8aa3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classifprobab_activetilscell'], name='tcga_cell_image_i_d33429_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classifprobab_normalepithelium'], name='tcga_cell_image_i_f3c70b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classifprobab_othercell'], name='tcga_cell_image_i_d649a1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classifprobab_unknownorambiguouscell'], name='tcga_cell_image_i_8370d6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cell',
+            index=models.Index(fields=['image', 'classifprobab_background'], name='tcga_cell_image_i_39ac06_idx'),
+        ),
+    ]
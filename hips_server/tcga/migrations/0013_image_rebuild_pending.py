@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tcga', '0012_data_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='rebuild_pending',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,96 @@
+import pickle
+import shutil
+import numpy as np
+
+from functools import lru_cache
+from pathlib import Path
+
+from tcga.constants import TRANSFORMS_FOLDER
+
+
+# A fitted UMAP transform is stored in a folder per UMAPTransform:
+#   transform.pkl   pickle of the model, with large arrays replaced by references
+#   arrays/N.npy    the referenced arrays (embedding, training data, kNN graph, search index)
+# The arrays are memory-mapped when loading, so a load only reads the small pickle
+# and the pages of the arrays that a transform actually touches.
+TRANSFORM_FILE = 'transform.pkl'
+ARRAYS_FOLDER = 'arrays'
+# Arrays smaller than this stay inside the pickle
+MIN_ARRAY_BYTES = 1 << 16
+# Number of loaded transforms kept in memory per process
+TRANSFORM_CACHE_SIZE = 4
+
+
+# Compiled search functions that NNDescent recompiles when unpickled; pickling them
+# would only add their size to the file and the time to rebuild them to every load
+NNDESCENT_COMPILED = ['_search_function', '_tree_search', '_deheap_function']
+
+
+class ArrayPickler(pickle.Pickler):
+    def __init__(self, file, folder):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.protocol = pickle.HIGHEST_PROTOCOL
+        self.folder = folder
+        self.saved = {}
+
+    def reducer_override(self, obj):
+        # Checked by name, since importing pynndescent takes seconds of numba compilation
+        if type(obj).__name__ != 'NNDescent' or not type(obj).__module__.startswith('pynndescent'):
+            return NotImplemented
+        constructor, args, state, *rest = obj.__reduce_ex__(self.protocol)
+        state = {k: v for k, v in state.items() if k not in NNDESCENT_COMPILED}
+        return (constructor, args, state, *rest)
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject or obj.nbytes < MIN_ARRAY_BYTES:
+            return None
+        # The same array may be referenced from several attributes
+        if id(obj) not in self.saved:
+            name = f'{len(self.saved)}.npy'
+            np.save(self.folder / name, obj)
+            self.saved[id(obj)] = (name, obj)
+        return self.saved[id(obj)][0]
+
+
+class ArrayUnpickler(pickle.Unpickler):
+    def __init__(self, file, folder):
+        super().__init__(file)
+        self.folder = folder
+
+    def persistent_load(self, pid):
+        # Copy-on-write, as some code paths write to model arrays
+        return np.load(self.folder / pid, mmap_mode='c')
+
+
+def get_transform_folder(transform_id):
+    return TRANSFORMS_FOLDER / str(transform_id)
+
+
+def save_transform(transform, transform_id):
+    """Write a fitted transform to its folder; returns the pickle path relative to TRANSFORMS_FOLDER."""
+    folder = get_transform_folder(transform_id)
+    tmp_folder = folder.with_name(folder.name + '.tmp')
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    (tmp_folder / ARRAYS_FOLDER).mkdir(parents=True)
+    with open(tmp_folder / TRANSFORM_FILE, 'wb') as f:
+        ArrayPickler(f, tmp_folder / ARRAYS_FOLDER).dump(transform)
+    shutil.rmtree(folder, ignore_errors=True)
+    tmp_folder.rename(folder)
+    return f'{transform_id}/{TRANSFORM_FILE}'
+
+
+def delete_transform(transform_id):
+    shutil.rmtree(get_transform_folder(transform_id), ignore_errors=True)
+
+
+@lru_cache(maxsize=TRANSFORM_CACHE_SIZE)
+def _load_transform(path, mtime):
+    # Plain pickles written before arrays were split out load the same way
+    with open(path, 'rb') as f:
+        return ArrayUnpickler(f, path.parent / ARRAYS_FOLDER).load()
+
+
+def load_transform(transform_instance):
+    """The fitted transform of a UMAPTransform, cached per process until its file changes."""
+    path = Path(transform_instance.pickled.path)
+    return _load_transform(path, path.stat().st_mtime_ns)
@@ -1,7 +1,16 @@
+import time
+
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.core.files.storage import FileSystemStorage
 
 from .constants import DEFAULT_UMAP_KWARGS, VECTOR_COLUMNS, TRANSFORMS_FOLDER
+from .feature_store import FeatureStore
+from .model_store import delete_transform
+from .result_store import ResultPoints
+from .id_runs import empty_id_runs
 
 
 transforms_fs = FileSystemStorage(location=TRANSFORMS_FOLDER)
@@ -15,9 +24,34 @@ def get_vector_columns():
     return VECTOR_COLUMNS
 
 
+# Feature vector columns that are also copied into indexed float fields of Cell, to their field names.
+# Adding one takes a field and an index on Cell, a migration and backfill_indexed_columns.
+INDEXED_FIELDS = {
+    'Size.Area': 'size_area',
+    'Shape.Circularity': 'shape_circularity',
+    'ClassifProbab.CancerEpithelium': 'classifprobab_cancerepithelium',
+    'ClassifProbab.StromalCellNOS': 'classifprobab_stromalcellnos',
+    'ClassifProbab.ActiveStromalCellNOS': 'classifprobab_activestromalcellnos',
+    'ClassifProbab.TILsCell': 'classifprobab_tilscell',
+    'ClassifProbab.ActiveTILsCell': 'classifprobab_activetilscell',
+    'ClassifProbab.NormalEpithelium': 'classifprobab_normalepithelium',
+    'ClassifProbab.OtherCell': 'classifprobab_othercell',
+    'ClassifProbab.UnknownOrAmbiguousCell': 'classifprobab_unknownorambiguouscell',
+    'ClassifProbab.BACKGROUND': 'classifprobab_background',
+}
+
+
 class Image(models.Model):
     name = models.CharField(max_length=255)
     tile_url = models.CharField(max_length=500)
+    # Set in the transaction of every ROI change and cleared once the data derived from
+    # the cells of the image is rebuilt, so an interrupted populate run rebuilds it on resume
+    rebuild_pending = models.BooleanField(default=False)
+
+
+@receiver(post_delete, sender=Image)
+def delete_image_features(sender, instance, **kwargs):
+    FeatureStore(instance.id).delete()
 
 
 class Cell(models.Model):
@@ -28,20 +62,133 @@ class Cell(models.Model):
     height = models.FloatField()
     orientation = models.FloatField()
     classification = models.CharField(max_length=255)
-    vector = models.JSONField(default=list)
+    # Feature vectors live in the columnar FeatureStore of the image, see feature_store.py;
+    # the columns in INDEXED_FIELDS are also copied into these fields for indexed filtering
+    size_area = models.FloatField(null=True)
+    shape_circularity = models.FloatField(null=True)
+    classifprobab_cancerepithelium = models.FloatField(null=True)
+    classifprobab_stromalcellnos = models.FloatField(null=True)
+    classifprobab_activestromalcellnos = models.FloatField(null=True)
+    classifprobab_tilscell = models.FloatField(null=True)
+    classifprobab_activetilscell = models.FloatField(null=True)
+    classifprobab_normalepithelium = models.FloatField(null=True)
+    classifprobab_othercell = models.FloatField(null=True)
+    classifprobab_unknownorambiguouscell = models.FloatField(null=True)
+    classifprobab_background = models.FloatField(null=True)
+
+    class Meta:
+        indexes = [
+            # Supports paging through the cells of an image in id order
+            models.Index(fields=['image', 'id'], name='cell_image_id_idx'),
+            models.Index(fields=['image', 'classification'], name='cell_image_class_idx'),
+            # Names of these are generated from their fields
+            models.Index(fields=['image', 'size_area']),
+            models.Index(fields=['image', 'shape_circularity']),
+            models.Index(fields=['image', 'classifprobab_cancerepithelium']),
+            models.Index(fields=['image', 'classifprobab_stromalcellnos']),
+            models.Index(fields=['image', 'classifprobab_activestromalcellnos']),
+            models.Index(fields=['image', 'classifprobab_tilscell']),
+            models.Index(fields=['image', 'classifprobab_activetilscell']),
+            models.Index(fields=['image', 'classifprobab_normalepithelium']),
+            models.Index(fields=['image', 'classifprobab_othercell']),
+            models.Index(fields=['image', 'classifprobab_unknownorambiguouscell']),
+            models.Index(fields=['image', 'classifprobab_background']),
+        ]
+
+
+class ROIManifest(models.Model):
+    # One row per ingested ROI file pair, used to skip unchanged ROIs on re-population
+    image = models.ForeignKey(Image, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    checksum = models.CharField(max_length=64)
+    first_cell_id = models.BigIntegerField(null=True)
+    last_cell_id = models.BigIntegerField(null=True)
+    cell_count = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['image', 'name'], name='unique_image_roi'),
+        ]
+
+
+class ColumnStats(models.Model):
+    # Summary statistics of one cell attribute over all cells of an Image, computed at ingest
+    image = models.ForeignKey(Image, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    kind = models.CharField(max_length=20)
+    count = models.BigIntegerField(default=0)
+    null_count = models.BigIntegerField(default=0)
+    minimum = models.FloatField(null=True)
+    maximum = models.FloatField(null=True)
+    mean = models.FloatField(null=True)
+    std = models.FloatField(null=True)
+    # Quantile (as a string key) to value, for numeric columns
+    quantiles = models.JSONField(default=dict)
+    # Distinct value to number of cells, for categorical columns
+    categories = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['image', 'name'], name='unique_image_column'),
+        ]
 
 
 class UMAPTransform(models.Model):
     name = models.CharField(max_length=255)
     created = models.DateTimeField(auto_now_add=True)
-    fitted_cells = models.ManyToManyField(Cell)
+    # Ids of the cells the transform was fitted to, as id runs (see id_runs.py)
+    fitted_ids = models.JSONField(default=empty_id_runs)
     column_names = models.JSONField(default=get_vector_columns)
     umap_kwargs = models.JSONField(default=get_default_umap_kwargs)
     pickled = models.FileField(storage=transforms_fs)
 
 
+@receiver(post_delete, sender=UMAPTransform)
+def delete_transform_files(sender, instance, **kwargs):
+    delete_transform(instance.id)
+
+
 class UMAPResult(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     transform = models.ForeignKey(UMAPTransform, on_delete=models.CASCADE)
-    transformed_cells = models.ManyToManyField(Cell)
-    scatterplot_data = models.JSONField()
+    # Ids of the transformed cells, as id runs (see id_runs.py)
+    transformed_ids = models.JSONField(default=empty_id_runs)
+    # The points themselves are stored in files, see result_store.py
+    cell_count = models.IntegerField(default=0)
+
+
+@receiver(post_delete, sender=UMAPResult)
+def delete_result_points(sender, instance, **kwargs):
+    ResultPoints(instance.id).delete()
+
+
+class DataVersion(models.Model):
+    # Counter bumped whenever the data behind a group of API responses changes, see response_cache.py.
+    # Keys: "images" (the image list), "image:<id>" (cells of an image), "umap" (transforms and results)
+    key = models.CharField(max_length=255, unique=True)
+    version = models.BigIntegerField(default=0)
+
+
+def bump_data_version(*keys):
+    for key in keys:
+        if DataVersion.objects.filter(key=key).update(version=F('version') + 1):
+            continue
+        # Counters start from the current time rather than 1, so that a recreated database
+        # does not reuse the versions, and so the ETags and cached responses, of an older one
+        _, created = DataVersion.objects.get_or_create(key=key, defaults=dict(version=time.time_ns()))
+        if not created:
+            DataVersion.objects.filter(key=key).update(version=F('version') + 1)
+
+
+@receiver([post_save, post_delete], sender=Image)
+def bump_image_versions(sender, instance, **kwargs):
+    bump_data_version('images', f'image:{instance.id}')
+
+
+@receiver([post_save, post_delete], sender=UMAPTransform)
+@receiver([post_save, post_delete], sender=UMAPResult)
+def bump_umap_version(sender, instance, **kwargs):
+    bump_data_version('umap')
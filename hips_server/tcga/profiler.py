@@ -0,0 +1,94 @@
+import re
+import sys
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from tcga.constants import PROFILES_FOLDER
+
+
+# Sampling profiler for slow requests. While requests are in flight, a background thread
+# samples the stacks of all threads of the process every interval; the samples taken during
+# a request that turns out slower than the threshold are written to PROFILES_FOLDER as
+# folded stacks ("root;caller;callee count" per line), the input of flamegraph.pl,
+# speedscope and similar tools. Work of async views runs in worker threads, so stacks are
+# not attributed to one thread: concurrent requests appear in each other's profiles.
+DEFAULT_INTERVAL = 0.005
+# Threads whose innermost frame is in these modules are waiting, not working
+IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py')
+
+
+def frame_label(frame):
+    code = frame.f_code
+    # Semicolons separate frames in folded stacks
+    return f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})'.replace(';', ':')
+
+
+def folded_stack(thread_name, frame):
+    if Path(frame.f_code.co_filename).name in IDLE_FILES:
+        return None
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ';'.join(reversed(labels))
+
+
+class RequestProfile:
+    def __init__(self):
+        self.samples = Counter()
+
+    def write(self, name, seconds):
+        PROFILES_FOLDER.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r'[^\w.-]+', '_', name).strip('_')
+        path = PROFILES_FOLDER / f'{datetime.now():%Y%m%d-%H%M%S-%f}-{slug}-{seconds * 1000:.0f}ms.folded'
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+
+class SamplingProfiler:
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.profiles = set()
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start sampling for a new request."""
+        profile = RequestProfile()
+        with self.lock:
+            self.profiles.add(profile)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+                self.thread.start()
+        self.active.set()
+        return profile
+
+    def stop(self, profile):
+        with self.lock:
+            self.profiles.discard(profile)
+            if not self.profiles:
+                self.active.clear()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while True:
+            self.active.wait()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = [
+                folded_stack(names.get(thread_id, str(thread_id)), frame)
+                for thread_id, frame in sys._current_frames().items()
+                if thread_id != own_id
+            ]
+            stacks = [stack for stack in stacks if stack]
+            with self.lock:
+                for profile in self.profiles:
+                    profile.samples.update(stacks)
+            time.sleep(self.interval)
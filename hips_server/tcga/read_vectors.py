@@ -1,36 +1,135 @@
+import numpy as np
 import pandas
 
+from tcga.constants import VECTOR_COLUMNS, CATEGORICAL_COLUMNS
+from tcga.feature_store import encode_columns
 
-def get_case_vector(case_folder, rois=None):
-    results = None
-    meta_vectors = case_folder / 'nucleiMeta'
-    prop_vectors = case_folder / 'nucleiProps'
-    meta_vector_files = list(meta_vectors.glob('*.csv'))
-    prop_vector_files = list(prop_vectors.glob('*.csv'))
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+# Functions in this module do not touch the database,
+# so they can run in ingest worker processes.
+
+
+def get_vector_dtypes(columns=VECTOR_COLUMNS):
+    # Explicit CSV schema: strings for categorical columns, float64 for the rest
+    return {
+        c: 'str' if c in CATEGORICAL_COLUMNS else 'float64'
+        for c in columns
+    }
+
+
+def get_roi_vector_files(case_folder, rois=None):
+    """List (meta file, props file) pairs for each ROI of a case."""
+    results = []
+    meta_vector_files = sorted((case_folder / 'nucleiMeta').glob('*.csv'))
+    prop_vector_files = {
+        f.name: f for f in (case_folder / 'nucleiProps').glob('*.csv')
+    }
 
     for meta_vector_file in meta_vector_files:
-        roi_name = meta_vector_file.name.replace('.csv', '')
+        roi_name = meta_vector_file.stem
         if rois is None or roi_name in rois:
-            prop_vector_file = next((
-                f for f in prop_vector_files
-                if f.name == meta_vector_file.name
-            ), None)
+            prop_vector_file = prop_vector_files.get(meta_vector_file.name)
             if prop_vector_file:
-                meta = pandas.read_csv(
-                    str(meta_vector_file),
-                    usecols=lambda x: 'Unnamed' not in x
-                ).reset_index(drop=True)
-                props = pandas.read_csv(
-                    str(prop_vector_file),
-                    usecols=lambda x: 'Unnamed' not in x
-                ).reset_index(drop=True)
-                intersection_cols = list(meta.columns.intersection(props.columns))
-                props = props.drop(intersection_cols, axis=1)
-                vector = pandas.concat([meta, props], axis=1)
-                if results is None:
-                    results = vector
-                else:
-                    results = pandas.concat([results, vector])
+                results.append((meta_vector_file, prop_vector_file))
             else:
                 print('No prop file for', meta_vector_file.name)
     return results
+
+
+def read_csv_columns(path, columns):
+    """Read only the listed columns of a CSV file, with types from get_vector_dtypes."""
+    dtypes = get_vector_dtypes(columns)
+    try:
+        return pandas.read_csv(str(path), usecols=columns, dtype=dtypes, engine=CSV_ENGINE)
+    except ValueError:
+        # A numeric column holds text; read untyped and coerce instead
+        vector = pandas.read_csv(str(path), usecols=columns)
+        for c in columns:
+            if dtypes[c] == 'float64':
+                vector[c] = pandas.to_numeric(vector[c], errors='coerce')
+        return vector
+
+
+def read_csv_header(path):
+    return [
+        c for c in pandas.read_csv(str(path), nrows=0).columns
+        if 'Unnamed' not in c
+    ]
+
+
+def read_roi_vector(meta_vector_file, prop_vector_file, columns=VECTOR_COLUMNS):
+    """
+    Read the vector of one ROI from its meta and props files,
+    projected to the requested columns (in that order) where present.
+    """
+    meta_columns = [c for c in read_csv_header(meta_vector_file) if c in columns]
+    prop_columns = [
+        c for c in read_csv_header(prop_vector_file)
+        if c in columns and c not in meta_columns
+    ]
+    meta = read_csv_columns(meta_vector_file, meta_columns).reset_index(drop=True)
+    props = read_csv_columns(prop_vector_file, prop_columns).reset_index(drop=True)
+    vector = pandas.concat([meta, props], axis=1)
+    return vector[[c for c in columns if c in vector.columns]]
+
+
+def iter_case_vectors(case_folder, rois=None, columns=VECTOR_COLUMNS):
+    """Yield (roi name, vector) pairs for each ROI of a case, one ROI in memory at a time."""
+    for meta_vector_file, prop_vector_file in get_roi_vector_files(case_folder, rois):
+        yield meta_vector_file.stem, read_roi_vector(meta_vector_file, prop_vector_file, columns)
+
+
+def get_case_vector(case_folder, rois=None, columns=VECTOR_COLUMNS):
+    vectors = [vector for _, vector in iter_case_vectors(case_folder, rois, columns)]
+    if not len(vectors):
+        return None
+    return pandas.concat(vectors, ignore_index=True)
+
+
+def get_roi_offsets(roi_name):
+    # ROI names end with components like "left-1234_top-5678"
+    roi = {}
+    for component in roi_name.split('_')[2:]:
+        key, value = component.split('-')
+        roi[key] = int(value)
+    return roi.get('left'), roi.get('top')
+
+
+def prepare_roi(roi_name, vector):
+    """
+    Convert one ROI vector DataFrame into the compact arrays used to save Cells:
+    float64 Cell geometry fields and the encoded feature store columns.
+    """
+    left, top = get_roi_offsets(roi_name)
+    # Ensure correct column ordering for feature store
+    vector = vector[VECTOR_COLUMNS]
+
+    def column(name):
+        return vector[name].to_numpy(dtype=np.float64)
+
+    return dict(
+        name=roi_name,
+        count=len(vector),
+        fields=dict(
+            x=column('Unconstrained.Identifier.CentroidX') * 2 + left,
+            y=column('Unconstrained.Identifier.CentroidY') * 2 + top,
+            width=column('Size.MinorAxisLength') * 2,
+            height=column('Size.MajorAxisLength') * 2,
+            orientation=0 - column('Orientation.Orientation'),
+        ),
+        columns=encode_columns(vector),
+    )
+
+
+def prepare_roi_files(vector_files):
+    """Read and prepare the ROIs in one (meta file, props file) pair."""
+    vector = read_roi_vector(*vector_files)
+    return [
+        prepare_roi(roi_name, roi_vector)
+        for roi_name, roi_vector in vector.groupby('roiname')
+    ]
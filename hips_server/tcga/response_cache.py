@@ -0,0 +1,274 @@
+import gzip
+import hashlib
+import os
+import threading
+
+from asgiref.sync import sync_to_async
+from collections import OrderedDict
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+from tcga.constants import RESPONSES_FOLDER
+from tcga.metrics import timed
+from tcga.models import DataVersion
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Serialized responses of read-only endpoints, kept in a size-bounded in-memory LRU of each
+# server process and in a size-bounded folder shared by all processes. Entries are keyed by
+# a strong ETag computed from the request path and query, the response encoding and the
+# DataVersion counters of the data the response is made of, so bumping a counter (see
+# bump_data_version) makes every cached response and ETag that depends on it stale.
+# Stale entries are never looked up again and drop out of the LRUs.
+
+# Change when the serialization of cached responses changes
+CACHE_FORMAT = 1
+MEMORY_MAX_BYTES = getattr(settings, 'RESPONSE_CACHE_MEMORY_BYTES', 64 << 20)
+DISK_MAX_BYTES = getattr(settings, 'RESPONSE_CACHE_DISK_BYTES', 1 << 30)
+# Smaller bodies are sent uncompressed
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def get_encoding(request):
+    """Best encoding of the response accepted by the client: br, gzip or '' for none."""
+    accepted = {
+        part.split(';')[0].strip().lower()
+        for part in request.headers.get('Accept-Encoding', '').split(',')
+    }
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return ''
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        # mtime=0 so that equal bodies compress to equal bytes
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return body
+
+
+class ResponseCache:
+    """Bytes-bounded LRU of (content type, encoding, body) by ETag, in memory and on disk."""
+
+    def __init__(self, memory_max_bytes=MEMORY_MAX_BYTES, disk_max_bytes=DISK_MAX_BYTES, folder=RESPONSES_FOLDER):
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.folder = folder
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Bytes written to the folder since it was last pruned
+        self.written = 0
+
+    def _path(self, etag):
+        return self.folder / etag
+
+    def get(self, etag):
+        with self.lock:
+            entry = self.entries.get(etag)
+            if entry is not None:
+                self.entries.move_to_end(etag)
+                return entry
+        if not self.disk_max_bytes:
+            return None
+        path = self._path(etag)
+        try:
+            with open(path, 'rb') as f:
+                content_type, encoding = f.readline().decode().rstrip('\n').split('\t')
+                entry = (content_type, encoding, f.read())
+            # Keep the file's mtime as its last use for pruning
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        self._remember(etag, entry)
+        return entry
+
+    def put(self, etag, content_type, encoding, body):
+        entry = (content_type, encoding, body)
+        self._remember(etag, entry)
+        if not self.disk_max_bytes or len(body) > self.disk_max_bytes:
+            return
+        self.folder.mkdir(parents=True, exist_ok=True)
+        path = self._path(etag)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(f'{content_type}\t{encoding}\n'.encode())
+            f.write(body)
+        tmp_path.replace(path)
+        with self.lock:
+            self.written += len(body)
+            prune = self.written > self.disk_max_bytes // 10
+            if prune:
+                self.written = 0
+        if prune:
+            self.prune_folder()
+
+    def _remember(self, etag, entry):
+        size = len(entry[2])
+        if size > self.memory_max_bytes:
+            return
+        with self.lock:
+            if etag in self.entries:
+                self.size -= len(self.entries.pop(etag)[2])
+            self.entries[etag] = entry
+            self.size += size
+            while self.size > self.memory_max_bytes:
+                _, (_, _, body) = self.entries.popitem(last=False)
+                self.size -= len(body)
+
+    def prune_folder(self):
+        # Delete the least recently used files until the folder fits in disk_max_bytes
+        files = []
+        for path in self.folder.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        if self.folder.exists():
+            for path in self.folder.iterdir():
+                path.unlink(missing_ok=True)
+
+
+response_cache = ResponseCache()
+
+
+def get_data_versions(keys):
+    versions = dict(DataVersion.objects.filter(key__in=keys).values_list('key', 'version'))
+    return [versions.get(key, 0) for key in keys]
+
+
+def get_etag(request, keys, versions, encoding):
+    digest = hashlib.sha1()
+    for part in [CACHE_FORMAT, request.get_full_path(), *keys, *versions, encoding]:
+        digest.update(f'{part}\0'.encode())
+    return digest.hexdigest()
+
+
+def get_scope_keys(scopes, request, kwargs):
+    # Scopes whose fields are not all given by the path or query are left out
+    values = {**request.GET.dict(), **kwargs}
+    keys = []
+    for scope in scopes:
+        try:
+            keys.append(scope.format(**values))
+        except KeyError:
+            continue
+    return keys
+
+
+def is_not_modified(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix('W/').strip('"') for tag in if_none_match.split(',')]
+    return etag in tags or '*' in tags
+
+
+def set_cache_headers(response, etag, encoding=None):
+    response['ETag'] = f'"{etag}"'
+    # Clients may keep the response but must revalidate it before each use
+    response['Cache-Control'] = 'no-cache'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
+
+
+def not_modified_response(etag):
+    return set_cache_headers(HttpResponseNotModified(), etag)
+
+
+def cached_response(etag, entry):
+    content_type, encoding, body = entry
+    return set_cache_headers(HttpResponse(body, content_type=content_type), etag, encoding)
+
+
+def store_response(etag, encoding, response):
+    # Compress and keep successful responses; others are returned as they are
+    if response.status_code != 200 or response.streaming:
+        return response
+    body = response.content
+    if len(body) < MIN_COMPRESS_BYTES:
+        encoding = ''
+    with timed('compress'):
+        entry = (response['Content-Type'], encoding, compress(body, encoding))
+    response_cache.put(etag, *entry)
+    return cached_response(etag, entry)
+
+
+def etag_response(etag, response):
+    if response.status_code == 200:
+        set_cache_headers(response, etag)
+    return response
+
+
+def cache_response(*scopes, store=True):
+    """
+    View decorator, for use with ninja's decorate_view, that gives the responses of a
+    read-only endpoint strong ETags and answers matching If-None-Match headers with 304.
+    scopes are DataVersion keys the response depends on, as format strings of the path
+    and query parameters, e.g. 'image:{image_id}'. With store, responses are also compressed
+    and kept in the response cache; otherwise (for streamed binary payloads) they are only
+    given an ETag and sent as they are.
+    """
+    def decorator(view):
+        def prepare(request, kwargs):
+            keys = get_scope_keys(scopes, request, kwargs)
+            encoding = get_encoding(request) if store else ''
+            etag = get_etag(request, keys, get_data_versions(keys), encoding)
+            if is_not_modified(request, etag):
+                return etag, encoding, not_modified_response(etag)
+            entry = response_cache.get(etag) if store else None
+            if entry is not None:
+                return etag, encoding, cached_response(etag, entry)
+            return etag, encoding, None
+
+        def finish(etag, encoding, response):
+            if store:
+                return store_response(etag, encoding, response)
+            return etag_response(etag, response)
+
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, **kwargs):
+                etag, encoding, response = await sync_to_async(prepare)(request, kwargs)
+                if response is not None:
+                    return response
+                response = await view(request, **kwargs)
+                return await sync_to_async(finish)(etag, encoding, response)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, **kwargs):
+            etag, encoding, response = prepare(request, kwargs)
+            if response is not None:
+                return response
+            return finish(etag, encoding, view(request, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,66 @@
+import shutil
+import numpy as np
+
+from functools import cached_property
+
+from tcga.constants import RESULTS_FOLDER
+from tcga.feature_store import FeatureStore
+
+
+# The embedded points of a UMAPResult, in a folder per result, sorted by cell id:
+#   ids.i64   cell ids
+#   x.f32     x coordinates, normalized to [0, 1] over the whole result
+#   y.f32     y coordinates, normalized the same way
+
+
+class ResultPoints:
+    """Read-only, memory-mapped points of one UMAPResult."""
+
+    def __init__(self, result_id):
+        self.result_id = result_id
+        self.folder = RESULTS_FOLDER / str(result_id)
+
+    def exists(self):
+        return (self.folder / 'ids.i64').exists()
+
+    def delete(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _memmap(self, name, dtype):
+        path = self.folder / name
+        if not path.exists() or path.stat().st_size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    @cached_property
+    def ids(self):
+        return self._memmap('ids.i64', np.int64)
+
+    @cached_property
+    def x(self):
+        return self._memmap('x.f32', np.float32)
+
+    @cached_property
+    def y(self):
+        return self._memmap('y.f32', np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows_for_image(self, image_id):
+        # Rows of the points whose cells belong to the image
+        return np.flatnonzero(np.isin(self.ids, FeatureStore(image_id).ids, assume_unique=True))
+
+
+def save_result_points(result_id, ids, x, y):
+    points = ResultPoints(result_id)
+    order = np.argsort(ids, kind='stable')
+    tmp_folder = points.folder.with_name(points.folder.name + '.tmp')
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tmp_folder.mkdir(parents=True)
+    np.asarray(ids, dtype=np.int64)[order].tofile(tmp_folder / 'ids.i64')
+    np.asarray(x, dtype=np.float32)[order].tofile(tmp_folder / 'x.f32')
+    np.asarray(y, dtype=np.float32)[order].tofile(tmp_folder / 'y.f32')
+    points.delete()
+    tmp_folder.rename(points.folder)
+    return ResultPoints(result_id)
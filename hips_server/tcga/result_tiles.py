@@ -0,0 +1,255 @@
+import json
+import shutil
+import numpy as np
+
+from functools import cached_property
+
+from tcga.models import Cell
+from tcga.result_store import ResultPoints
+from tcga.spatial_index import get_spatial_index
+
+
+# Multi-resolution tiles over the [0, 1] x [0, 1] embedding of a UMAPResult, kept in a "tiles"
+# folder next to its points. At zoom level z the embedding is split into 2^z x 2^z tiles,
+# each of TILE_BINS x TILE_BINS bins. Points are ordered along a Z-order (Morton) curve over
+# a 2^FINE_BITS grid, so the points of any tile, and the bins of any tile at any level,
+# are one contiguous run of rows.
+#   tiles.json           levels, classifications and images of the points
+#   order.i64            point rows (as in ResultPoints) in Z-order
+#   codes.i64            Z-order codes of the points, sorted
+#   classes.i32          classification codes of the points in Z-order
+#   images.i32           indices into the images of tiles.json of the points in Z-order
+#   bins_Z.i64           Z-order codes of the non-empty bins at level Z, sorted
+#   class_counts_Z.i32   (bins, classes) counts per classification of those bins
+#   image_counts_Z.i32   (entries, 3) sparse bin row, image index and count, sorted by bin row
+FINE_BITS = 16
+TILE_BITS = 6
+TILE_BINS = 2 ** TILE_BITS
+# Tiles with at most this many points return the points instead of bins
+MAX_TILE_POINTS = 5000
+TILES_FOLDER = 'tiles'
+TILES_FILE = 'tiles.json'
+ID_CHUNK_SIZE = 10000
+
+
+def spread_bits(values):
+    # Insert a zero bit above each of the low 32 bits
+    values = np.asarray(values, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in [
+        (16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+        (2, 0x3333333333333333), (1, 0x5555555555555555),
+    ]:
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def compact_bits(values):
+    # Inverse of spread_bits
+    values = np.asarray(values, dtype=np.uint64) & np.uint64(0x5555555555555555)
+    for shift, mask in [
+        (1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+        (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF),
+    ]:
+        values = (values | (values >> np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def z_order(columns, rows):
+    return (spread_bits(columns) | (spread_bits(rows) << np.uint64(1))).astype(np.int64)
+
+
+def z_order_inverse(codes):
+    codes = np.asarray(codes, dtype=np.uint64)
+    return compact_bits(codes).astype(np.int64), compact_bits(codes >> np.uint64(1)).astype(np.int64)
+
+
+class ResultTiles:
+    """Read-only, memory-mapped tile pyramid of one UMAPResult."""
+
+    def __init__(self, result_id):
+        self.result_id = result_id
+        self.points = ResultPoints(result_id)
+        self.folder = self.points.folder / TILES_FOLDER
+
+    def exists(self):
+        return (self.folder / TILES_FILE).exists()
+
+    @cached_property
+    def info(self):
+        with open(self.folder / TILES_FILE) as f:
+            return json.load(f)
+
+    @property
+    def levels(self):
+        return self.info['levels']
+
+    @property
+    def classes(self):
+        return self.info['classes']
+
+    @property
+    def images(self):
+        return self.info['images']
+
+    def _memmap(self, name, dtype, columns=None):
+        path = self.folder / name
+        if not path.exists() or path.stat().st_size == 0:
+            return np.zeros((0, columns) if columns else 0, dtype=dtype)
+        array = np.memmap(path, dtype=dtype, mode='r')
+        return array.reshape(-1, columns) if columns else array
+
+    @cached_property
+    def codes(self):
+        return self._memmap('codes.i64', np.int64)
+
+    @cached_property
+    def order(self):
+        return self._memmap('order.i64', np.int64)
+
+    @cached_property
+    def point_classes(self):
+        return self._memmap('classes.i32', np.int32)
+
+    @cached_property
+    def point_images(self):
+        return self._memmap('images.i32', np.int32)
+
+    def tile_range(self, codes, z, x, y, level_bits):
+        # Rows of sorted Z-order codes on a 2^level_bits grid that fall inside tile (z, x, y)
+        shift = np.int64(2 * (level_bits - z))
+        start = int(z_order(x, y)) << shift
+        stop = (int(z_order(x, y)) + 1) << shift
+        return slice(*np.searchsorted(codes, [start, stop]))
+
+    def point_rows(self, z, x, y):
+        """Rows of the points inside tile (z, x, y), in Z-order."""
+        return self.tile_range(self.codes, z, x, y, FINE_BITS)
+
+    def bins(self, z, x, y):
+        """
+        Non-empty bins of tile (z, x, y) at one of the stored levels:
+        bin origins in embedding coordinates, bin size and per-class and per-image counts.
+        """
+        bin_codes = self._memmap(f'bins_{z}.i64', np.int64)
+        rows = self.tile_range(bin_codes, z, x, y, z + TILE_BITS)
+        columns, grid_rows = z_order_inverse(bin_codes[rows])
+        size = 1 / 2 ** (z + TILE_BITS)
+        entries = self._memmap(f'image_counts_{z}.i32', np.int32, 3)
+        entries = entries[slice(*np.searchsorted(entries[:, 0], [rows.start, rows.stop]))]
+        image_counts = np.zeros((rows.stop - rows.start, len(self.images)), dtype=np.int32)
+        image_counts[entries[:, 0] - rows.start, entries[:, 1]] = entries[:, 2]
+        return dict(
+            x=columns * size,
+            y=grid_rows * size,
+            size=size,
+            class_counts=self._memmap(f'class_counts_{z}.i32', np.int32, len(self.classes))[rows],
+            image_counts=image_counts,
+        )
+
+
+def get_point_classes(cell_image_ids):
+    """Classification codes into a list of classifications, from the SpatialIndex of each image."""
+    classes = sorted({
+        name for image_id in np.unique(cell_image_ids[:, 1])
+        for name in get_spatial_index(int(image_id)).classes
+    })
+    codes = np.full(len(cell_image_ids), -1, dtype=np.int32)
+    for image_id in np.unique(cell_image_ids[:, 1]):
+        mask = cell_image_ids[:, 1] == image_id
+        index = get_spatial_index(int(image_id))
+        rows = np.searchsorted(index.ids(index.order), cell_image_ids[mask, 0])
+        lookup = np.searchsorted(classes, index.classes).astype(np.int32)
+        codes[mask] = lookup[index.codes(index.order)[rows]]
+    return codes, classes
+
+
+def get_point_images(ids):
+    # Image of each of the sorted cell ids, for results whose tiles are built after the fact
+    image_ids = np.zeros(len(ids), dtype=np.int64)
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        chunk = ids[start:start + ID_CHUNK_SIZE]
+        cells = np.array(
+            Cell.objects.filter(id__gte=chunk[0], id__lte=chunk[-1])
+            .order_by('id').values_list('id', 'image_id'),
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        rows = np.searchsorted(cells[:, 0], chunk)
+        if (rows >= len(cells)).any() or (cells[np.minimum(rows, len(cells) - 1), 0] != chunk).any():
+            raise Exception('Some cells of UMAPResult points no longer exist.')
+        image_ids[start:start + len(chunk)] = cells[rows, 1]
+    return image_ids
+
+
+def build_result_tiles(result_id, image_ids=None):
+    """
+    (Re)build the tile pyramid of a UMAPResult from its points. image_ids gives the image
+    of each point in ResultPoints order; it is looked up from the Cells when not given.
+    Levels are added until every tile of the last level holds at most MAX_TILE_POINTS points.
+    """
+    points = ResultPoints(result_id)
+    ids = np.asarray(points.ids)
+    if image_ids is None:
+        image_ids = get_point_images(ids)
+    cell_image_ids = np.stack([ids, image_ids], axis=1)
+    point_classes, classes = get_point_classes(cell_image_ids)
+    images, point_images = np.unique(image_ids, return_inverse=True)
+
+    grid = 2 ** FINE_BITS
+    columns = np.clip((np.asarray(points.x) * grid).astype(np.int64), 0, grid - 1)
+    rows = np.clip((np.asarray(points.y) * grid).astype(np.int64), 0, grid - 1)
+    codes = z_order(columns, rows)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    point_classes, point_images = point_classes[order], point_images[order]
+
+    tiles = ResultTiles(result_id)
+    tmp_folder = tiles.folder.with_name(TILES_FOLDER + '.tmp')
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tmp_folder.mkdir(parents=True)
+    order.tofile(tmp_folder / 'order.i64')
+    codes.tofile(tmp_folder / 'codes.i64')
+    point_classes.tofile(tmp_folder / 'classes.i32')
+    point_images.astype(np.int32).tofile(tmp_folder / 'images.i32')
+
+    known = point_classes >= 0
+    levels = 0
+    for z in range(FINE_BITS - TILE_BITS + 1):
+        # Codes are sorted, so the points of each bin are consecutive
+        bin_codes = codes >> np.int64(2 * (FINE_BITS - z - TILE_BITS))
+        starts = np.ones(len(bin_codes), dtype=bool)
+        starts[1:] = bin_codes[1:] != bin_codes[:-1]
+        bin_of_point = np.cumsum(starts) - 1
+        bin_codes = bin_codes[starts]
+        n_bins = len(bin_codes)
+        class_counts = np.bincount(
+            bin_of_point[known] * len(classes) + point_classes[known],
+            minlength=n_bins * len(classes),
+        ).astype(np.int32).reshape(n_bins, len(classes))
+        pairs, counts = np.unique(bin_of_point * len(images) + point_images, return_counts=True)
+        image_counts = np.stack([pairs // len(images), pairs % len(images), counts], axis=1)
+        bin_codes.tofile(tmp_folder / f'bins_{z}.i64')
+        class_counts.tofile(tmp_folder / f'class_counts_{z}.i32')
+        image_counts.astype(np.int32).tofile(tmp_folder / f'image_counts_{z}.i32')
+        levels = z + 1
+        tile_codes = codes >> np.int64(2 * (FINE_BITS - z))
+        tile_starts = np.flatnonzero(np.diff(tile_codes, prepend=-1))
+        if np.diff(tile_starts, append=len(codes)).max(initial=0) <= MAX_TILE_POINTS:
+            break
+
+    with open(tmp_folder / TILES_FILE, 'w') as f:
+        json.dump(dict(
+            levels=levels,
+            classes=classes,
+            images=images.tolist(),
+            point_count=len(ids),
+        ), f)
+    shutil.rmtree(tiles.folder, ignore_errors=True)
+    tmp_folder.rename(tiles.folder)
+    return ResultTiles(result_id)
+
+
+def get_result_tiles(result_id):
+    tiles = ResultTiles(result_id)
+    if not tiles.exists():
+        tiles = build_result_tiles(result_id)
+    return tiles
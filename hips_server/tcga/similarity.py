@@ -0,0 +1,63 @@
+import numpy as np
+
+from sklearn.metrics import pairwise_distances
+from sklearn.preprocessing import normalize
+
+from tcga.models import Cell
+from tcga.id_runs import IdRunSet
+from tcga.model_store import load_transform
+from tcga.umap_inputs import build_umap_input_matrix, get_numeric_columns
+
+
+DEFAULT_NEIGHBORS = 10
+MAX_NEIGHBORS = 1000
+
+
+def get_input_vector(transform_instance, cell_id=None, vector=None):
+    """
+    One row of the transform's input space: the normalized features of a cell, or a feature
+    vector with one value per numeric column of the transform (nulls as None), normalized the same way.
+    """
+    columns = get_numeric_columns(transform_instance.column_names)
+    if cell_id is not None:
+        image_id = Cell.objects.filter(id=cell_id).values_list('image_id', flat=True).first()
+        if image_id is None:
+            raise KeyError(f'Cell {cell_id} does not exist.')
+        return build_umap_input_matrix(np.array([[cell_id, image_id]], dtype=np.int64), columns)
+    if vector is None or len(vector) != len(columns):
+        raise ValueError(f'vector must have one value for each of the {len(columns)} numeric columns.')
+    data = np.array([[np.nan if v is None else v for v in vector]], dtype=np.float32)
+    data[np.isnan(data)] = -1
+    return normalize(data, axis=1, norm='l1', copy=False)
+
+
+def find_similar_cells(transform_instance, cell_id=None, vector=None, k=DEFAULT_NEIGHBORS):
+    """
+    The k cells the transform was fitted to that are nearest to a cell or feature vector
+    in the transform's input space, as dicts of id, image and distance, nearest first.
+    Uses the approximate nearest neighbor index that UMAP builds while fitting,
+    or an exact search when the transform was fitted to too few cells to build one.
+    """
+    transform = load_transform(transform_instance)
+    query = get_input_vector(transform_instance, cell_id, vector)
+    fitted_ids = IdRunSet.from_dict(transform_instance.fitted_ids).ids()
+    if len(fitted_ids) != transform._raw_data.shape[0]:
+        raise ValueError(f'The fitted cells of transform {transform_instance.id} no longer match its index.')
+    k = min(k, len(fitted_ids))
+    index = getattr(transform, '_knn_search_index', None)
+    if index is not None and not transform._small_data:
+        rows, distances = index.query(query, k=k)
+        rows, distances = rows[0], distances[0]
+    else:
+        all_distances = pairwise_distances(
+            query, transform._raw_data, metric=transform.metric, **(transform._metric_kwds or {})
+        )[0]
+        rows = np.argsort(all_distances, kind='stable')[:k]
+        distances = all_distances[rows]
+    ids = fitted_ids[rows]
+    # Cells removed since fitting have no image
+    images = dict(Cell.objects.filter(id__in=ids.tolist()).values_list('id', 'image_id'))
+    return [
+        dict(id=int(cell_id), image=images.get(int(cell_id)), distance=float(distance))
+        for cell_id, distance in zip(ids, distances)
+    ]
@@ -0,0 +1,227 @@
+import json
+import shutil
+import numpy as np
+
+from functools import cached_property
+from itertools import islice
+
+from tcga.models import Cell
+from tcga.constants import FEATURES_FOLDER
+
+
+# Uniform grid over the cells of one Image, kept in a "spatial" folder next to its FeatureStore:
+#   grid.json        grid cell size, grid shape (rows, columns) and the list of classifications
+#   offsets.i64      CSR offsets: cells of grid cell k (row-major) are rows offsets[k]:offsets[k + 1]
+#   ids.i64          cell ids ordered by grid cell, then id
+#   order.i64        index row of each cell in id order, to read the columns below in id order
+#   NAME.f32         x, y, width, height and orientation in the same order
+#   classes.i32      classification codes in the same order
+#   counts.i32       pre-aggregated (rows, columns, classes) cell counts per grid cell
+GRID_CELL_SIZE = 256
+SPATIAL_FOLDER = 'spatial'
+GRID_FILE = 'grid.json'
+GEOMETRY_FIELDS = ['x', 'y', 'width', 'height', 'orientation']
+# Cells read from the database at a time while building an index
+CHUNK_SIZE = 10000
+
+
+class MissingIndexError(Exception):
+    pass
+
+
+class SpatialIndex:
+    """Read-only, memory-mapped uniform grid index of the cells of one Image."""
+
+    def __init__(self, image_id):
+        self.image_id = image_id
+        self.folder = FEATURES_FOLDER / str(image_id) / SPATIAL_FOLDER
+
+    def exists(self):
+        return (self.folder / GRID_FILE).exists()
+
+    def delete(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    @cached_property
+    def grid(self):
+        with open(self.folder / GRID_FILE) as f:
+            return json.load(f)
+
+    @property
+    def cell_size(self):
+        return self.grid['cell_size']
+
+    @property
+    def shape(self):
+        return tuple(self.grid['shape'])
+
+    @property
+    def classes(self):
+        return self.grid['classes']
+
+    def _memmap(self, name, dtype, shape=None):
+        path = self.folder / name
+        if not path.exists() or path.stat().st_size == 0:
+            return np.zeros(shape or 0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+    @cached_property
+    def offsets(self):
+        return self._memmap('offsets.i64', np.int64)
+
+    @cached_property
+    def counts(self):
+        return self._memmap('counts.i32', np.int32, (*self.shape, len(self.classes)))
+
+    @cached_property
+    def order(self):
+        return self._memmap('order.i64', np.int64)
+
+    def ids(self, rows):
+        return self._memmap('ids.i64', np.int64)[rows]
+
+    def codes(self, rows):
+        return self._memmap('classes.i32', np.int32)[rows]
+
+    def geometry(self, name, rows):
+        return self._memmap(f'{name}.f32', np.float32)[rows]
+
+    def grid_window(self, bbox):
+        # Grid rows and columns overlapping a (left, top, right, bottom) box, as two slices
+        left, top, right, bottom = bbox
+        n_rows, n_columns = self.shape
+
+        def window(start, stop, size):
+            start, stop = start // self.cell_size, stop // self.cell_size + 1
+            return slice(int(np.clip(start, 0, size)), int(np.clip(stop, 0, size)))
+
+        return window(top, bottom, n_rows), window(left, right, n_columns)
+
+    def count(self, bbox):
+        """Number of cells in grid cells overlapping the box; an upper bound for the exact count."""
+        rows, columns = self.grid_window(bbox)
+        return int(self.counts[rows, columns].sum())
+
+    def query(self, bbox):
+        """Rows (in index order) of the cells whose centroid lies inside the box."""
+        rows, columns = self.grid_window(bbox)
+        n_columns = self.shape[1]
+        if rows.start >= rows.stop or columns.start >= columns.stop:
+            return np.empty(0, dtype=np.int64)
+        # Each grid row of the window is one contiguous run of index rows
+        runs = [
+            np.arange(
+                self.offsets[row * n_columns + columns.start],
+                self.offsets[row * n_columns + columns.stop],
+            )
+            for row in range(rows.start, rows.stop)
+        ]
+        candidates = np.concatenate(runs)
+        left, top, right, bottom = bbox
+        x, y = self.geometry('x', candidates), self.geometry('y', candidates)
+        inside = (x >= left) & (x <= right) & (y >= top) & (y <= bottom)
+        return candidates[inside]
+
+    def bins(self, bbox, factor):
+        """
+        Class counts per bin for the grid cells overlapping the box, where each bin
+        merges factor x factor grid cells. Returns bin origins, total and per-class counts.
+        """
+        rows, columns = self.grid_window(bbox)
+        # Align the window to whole bins
+        rows = slice(rows.start - rows.start % factor, rows.stop)
+        columns = slice(columns.start - columns.start % factor, columns.stop)
+        counts = self.counts[rows, columns]
+        n_rows, n_columns = -(-counts.shape[0] // factor), -(-counts.shape[1] // factor)
+        n_classes = len(self.classes)
+        padded = np.zeros((n_rows * factor, n_columns * factor, n_classes), dtype=np.int32)
+        padded[:counts.shape[0], :counts.shape[1]] = counts
+        binned = padded.reshape(n_rows, factor, n_columns, factor, n_classes).sum(axis=(1, 3))
+        bin_rows, bin_columns = np.nonzero(binned.sum(axis=2))
+        bin_size = self.cell_size * factor
+        return dict(
+            x=(columns.start // factor + bin_columns) * bin_size,
+            y=(rows.start // factor + bin_rows) * bin_size,
+            size=bin_size,
+            counts=binned[bin_rows, bin_columns],
+        )
+
+
+def read_cells(image_id):
+    """
+    Ids, geometry fields and classification codes of the Cells of an Image in id order,
+    streamed from the database in chunks into arrays. Returns (ids, geometry, codes, classes).
+    """
+    cells = Cell.objects.filter(image__id=image_id).order_by('id')
+    count = cells.count()
+    ids = np.empty(count, dtype=np.int64)
+    geometry = {name: np.empty(count, dtype=np.float64) for name in GEOMETRY_FIELDS}
+    # Codes in order of first appearance, renumbered in sorted order of the classes below
+    codes = np.empty(count, dtype=np.int32)
+    seen = {}
+    rows = cells.values_list('id', *GEOMETRY_FIELDS, 'classification').iterator(chunk_size=CHUNK_SIZE)
+    read = 0
+    while read < count and (chunk := list(islice(rows, min(CHUNK_SIZE, count - read)))):
+        values = list(zip(*chunk))
+        rows_read = slice(read, read + len(chunk))
+        ids[rows_read] = values[0]
+        for name, field_values in zip(GEOMETRY_FIELDS, values[1:-1]):
+            geometry[name][rows_read] = field_values
+        codes[rows_read] = [seen.setdefault(c, len(seen)) for c in values[-1]]
+        read += len(chunk)
+    # Cells deleted while reading leave fewer rows than counted
+    ids, codes = ids[:read], codes[:read]
+    geometry = {name: field_values[:read] for name, field_values in geometry.items()}
+    classes = sorted(seen)
+    renumber = np.empty(len(seen), dtype=np.int32)
+    renumber[[seen[c] for c in classes]] = np.arange(len(classes), dtype=np.int32)
+    return ids, geometry, renumber[codes], classes
+
+
+def build_spatial_index(image_id, cell_size=GRID_CELL_SIZE):
+    """(Re)build the SpatialIndex of an Image from its Cells."""
+    ids, geometry, codes, classes = read_cells(image_id)
+
+    n_columns = int(geometry['x'].max(initial=0) // cell_size) + 1
+    n_rows = int(geometry['y'].max(initial=0) // cell_size) + 1
+    grid_columns = np.clip(geometry['x'] // cell_size, 0, None).astype(np.int64)
+    grid_rows = np.clip(geometry['y'] // cell_size, 0, None).astype(np.int64)
+    keys = grid_rows * n_columns + grid_columns
+    # ids are sorted already, so a stable sort keeps id order within each grid cell
+    order = np.argsort(keys, kind='stable')
+    offsets = np.zeros(n_rows * n_columns + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n_rows * n_columns), out=offsets[1:])
+    counts = np.zeros((n_rows, n_columns, len(classes)), dtype=np.int32)
+    np.add.at(counts, (grid_rows, grid_columns, codes), 1)
+
+    index = SpatialIndex(image_id)
+    # Write into a new folder and swap it in, so an interrupted build leaves no partial index
+    tmp_folder = index.folder.with_name(SPATIAL_FOLDER + '.tmp')
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tmp_folder.mkdir(parents=True)
+    offsets.tofile(tmp_folder / 'offsets.i64')
+    ids[order].tofile(tmp_folder / 'ids.i64')
+    np.argsort(order).tofile(tmp_folder / 'order.i64')
+    for name, field_values in geometry.items():
+        field_values[order].astype(np.float32).tofile(tmp_folder / f'{name}.f32')
+    codes[order].astype(np.int32).tofile(tmp_folder / 'classes.i32')
+    counts.tofile(tmp_folder / 'counts.i32')
+    with open(tmp_folder / GRID_FILE, 'w') as f:
+        json.dump(dict(
+            cell_size=cell_size,
+            shape=[n_rows, n_columns],
+            classes=classes,
+            cell_count=len(ids),
+        ), f)
+    index.delete()
+    tmp_folder.rename(index.folder)
+    return SpatialIndex(image_id)
+
+
+def get_spatial_index(image_id):
+    # Indexes are only built by populate (see ingest.update_case), never while serving requests,
+    # where concurrent builds by several server processes would race on the same folders
+    index = SpatialIndex(image_id)
+    if not index.exists():
+        raise MissingIndexError(f'The cell index of image {image_id} is not built yet; run populate to build it.')
+    return index
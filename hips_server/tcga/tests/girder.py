@@ -0,0 +1,118 @@
+import hashlib
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class GirderStandIn:
+    """
+    Local HTTP server imitating the Girder endpoints used by CaseDownloader:
+    folder and item listings, item files and file downloads, with Range support.
+
+    tree maps folder names to nested folders (dicts) or file contents (bytes),
+    under a root collection with id 'collection'. Requests are recorded as
+    (path, Range header) pairs in requests.
+    """
+
+    def __init__(self, tree):
+        self.folders = {}
+        self.items = {}
+        self.files = {}
+        self.contents = {}
+        self.requests = []
+        self._ids = 0
+        self._add_folder('collection', tree)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def api_url(self):
+        return f'http://127.0.0.1:{self.server.server_port}/api/v1'
+
+    def _new_id(self):
+        self._ids += 1
+        return f'{self._ids:024x}'
+
+    def _add_folder(self, folder_id, tree):
+        self.folders[folder_id] = []
+        self.items[folder_id] = []
+        for name, value in tree.items():
+            if isinstance(value, dict):
+                child_id = self._new_id()
+                self.folders[folder_id].append(dict(_id=child_id, name=name))
+                self._add_folder(child_id, value)
+            else:
+                item_id, file_id = self._new_id(), self._new_id()
+                self.items[folder_id].append(dict(_id=item_id, name=name))
+                self.files[item_id] = [dict(
+                    _id=file_id, name=name, size=len(value),
+                    sha512=hashlib.sha512(value).hexdigest(),
+                )]
+                self.contents[file_id] = value
+
+    def file(self, name):
+        """The file metadata of an item by name, to adjust what the server reports."""
+        return next(
+            file for files in self.files.values() for file in files if file['name'] == name
+        )
+
+    def downloads(self):
+        return [(path, byte_range) for path, byte_range in self.requests if path.endswith('/download')]
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                stand_in.requests.append((url.path, self.headers.get('Range')))
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                offset = int(query.get('offset', 0))
+                limit = int(query.get('limit', 0)) or None
+                page = slice(offset, offset + limit if limit else None)
+                parts = url.path.strip('/').split('/')[2:]
+                if parts == ['folder']:
+                    listing = stand_in.folders.get(query.get('parentId'), [])
+                elif parts == ['item']:
+                    listing = stand_in.items.get(query.get('folderId'), [])
+                elif len(parts) == 3 and parts[0] == 'item' and parts[2] == 'files':
+                    listing = stand_in.files.get(parts[1], [])
+                elif len(parts) == 3 and parts[0] == 'file' and parts[2] == 'download':
+                    return self.download(parts[1])
+                else:
+                    return self.send_body(404, b'{}')
+                self.send_body(200, json.dumps(listing[page]).encode())
+
+            def download(self, file_id):
+                data = stand_in.contents.get(file_id)
+                if data is None:
+                    return self.send_body(404, b'{}')
+                byte_range = self.headers.get('Range')
+                if byte_range:
+                    start = int(byte_range.removeprefix('bytes=').split('-')[0])
+                    return self.send_body(206, data[start:], 'application/octet-stream')
+                self.send_body(200, data, 'application/octet-stream')
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,85 @@
+import tempfile
+
+from pathlib import Path
+
+from django.test import SimpleTestCase
+
+from tcga.download import CaseDownloader, DownloadError, PARTIAL_SUFFIX
+from tcga.tests.girder import GirderStandIn
+
+
+META = b'Identifier.ObjectCode,Identifier.CentroidX\n' + b''.join(
+    f'{i},{i * 0.5}\n'.encode() for i in range(5000)
+)
+PROPS = b'Size.Area,Shape.Circularity\n' + b''.join(
+    f'{i % 97},{(i % 13) / 13}\n'.encode() for i in range(5000)
+)
+TREE = {
+    'caseA': {
+        'caseA.svs': b'not an image',
+        'nucleiMeta': {'roi-0.csv': META},
+        'nucleiProps': {'roi-0.csv': PROPS},
+    },
+    # Skipped by default
+    'test': {'test.svs': b'', 'nucleiMeta': {}},
+    # Skipped for lack of an image
+    'caseB': {'nucleiMeta': {'roi-0.csv': META}},
+}
+
+
+class CaseDownloaderTest(SimpleTestCase):
+    def setUp(self):
+        self.girder = GirderStandIn(TREE).__enter__()
+        self.addCleanup(self.girder.__exit__)
+        self.downloader = CaseDownloader(self.girder.api_url, workers=2)
+        self.addCleanup(self.downloader.close)
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = Path(folder.name)
+
+    def test_list_cases(self):
+        cases = self.downloader.list_cases('collection')
+        self.assertEqual([case['name'] for case in cases], ['caseA'])
+        cases = self.downloader.list_cases('collection', ['test'])
+        self.assertEqual([case['name'] for case in cases], ['test'])
+
+    def test_download_case(self):
+        case, = self.downloader.list_cases('collection')
+        total = self.downloader.download_case(case, self.folder / 'caseA')
+        self.assertEqual(total, len(META) + len(PROPS))
+        self.assertEqual((self.folder / 'caseA/nucleiMeta/roi-0.csv').read_bytes(), META)
+        self.assertEqual((self.folder / 'caseA/nucleiProps/roi-0.csv').read_bytes(), PROPS)
+        self.assertEqual(list(self.folder.rglob('*' + PARTIAL_SUFFIX)), [])
+
+        # Complete files are not fetched again
+        downloads = len(self.girder.downloads())
+        self.assertEqual(self.downloader.download_case(case, self.folder / 'caseA'), 0)
+        self.assertEqual(len(self.girder.downloads()), downloads)
+
+    def test_resume_partial_file(self):
+        path = self.folder / 'roi-0.csv'
+        partial = Path(str(path) + PARTIAL_SUFFIX)
+        partial.write_bytes(META[:1000])
+        fetched = self.downloader.download_file(self.girder.file('roi-0.csv'), path)
+        self.assertEqual(fetched, len(META) - 1000)
+        self.assertEqual(self.girder.downloads()[-1][1], 'bytes=1000-')
+        self.assertEqual(path.read_bytes(), META)
+        self.assertFalse(partial.exists())
+
+    def test_checksum_mismatch(self):
+        file = dict(self.girder.file('roi-0.csv'), sha512='0' * 128)
+        path = self.folder / 'roi-0.csv'
+        with self.assertRaises(DownloadError):
+            self.downloader.download_file(file, path)
+        self.assertFalse(path.exists())
+        self.assertFalse(Path(str(path) + PARTIAL_SUFFIX).exists())
+
+    def test_size_mismatch(self):
+        # The server sends fewer bytes than the metadata promises
+        file = dict(self.girder.file('roi-0.csv'), size=len(META) + 10)
+        path = self.folder / 'roi-0.csv'
+        with self.assertRaises(DownloadError):
+            self.downloader.download_file(file, path)
+        self.assertFalse(path.exists())
+        # The short partial file is kept, to be resumed
+        self.assertEqual(Path(str(path) + PARTIAL_SUFFIX).read_bytes(), META)
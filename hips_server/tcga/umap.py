@@ -1,20 +1,75 @@
+import os
 import re
 import umap
-import tempfile
-import pickle
+import multiprocessing
 import numpy as np
-import pandas as pd
 
+from contextlib import nullcontext
 from datetime import datetime
-from pathlib import Path
-from sklearn.preprocessing import normalize
 
-from django.core.files.base import ContentFile
-from tcga.models import Image, Cell, UMAPTransform, UMAPResult
+from django.db import connections, transaction
+from tcga.models import Image, Cell, ColumnStats, UMAPTransform, UMAPResult
 from tcga.constants import VECTOR_COLUMNS, DEFAULT_UMAP_KWARGS
+from tcga.spatial_index import get_spatial_index
+from tcga.model_store import save_transform, load_transform
+from tcga.result_store import ResultPoints, save_result_points
+from tcga.result_tiles import build_result_tiles
+from tcga.id_runs import encode_id_runs
+from tcga.umap_inputs import (
+    build_umap_input_matrix, get_input_cache_file, get_numeric_columns, get_umap_input_matrix,
+)
 
 
-def get_image_and_cell_sets(**kwargs):
+ID_CHUNK_SIZE = 10000
+SAMPLE_MODES = ['first', 'random', 'stratified']
+# Cells per chunk in apply_transform
+APPLY_CHUNK_SIZE = 50000
+
+
+def get_cell_classes(images, cells):
+    # Distinct classifications from the column statistics computed at ingest, when available
+    stats = ColumnStats.objects.filter(image__in=images, name='classification')
+    if len(stats) == len(images):
+        return sorted(set().union(*[s.categories for s in stats]))
+    return cells.values_list('classification', flat=True).distinct()
+
+
+def get_cell_image_ids(cells):
+    # (id, image id) pairs without loading Cell instances
+    pairs = cells.values_list('id', 'image_id').iterator(chunk_size=ID_CHUNK_SIZE)
+    return np.fromiter(pairs, dtype=np.dtype((np.int64, 2))).reshape(-1, 2)
+
+
+class CellSelection:
+    """
+    The cells chosen for a UMAP command, resolved once into sorted id arrays
+    so that every later step (input matrix, names, fitted and transformed cells)
+    works on the same population without querying it again.
+    """
+
+    def __init__(self, images, cell_image_ids, classes=None):
+        self.images = list(images)
+        # (id, image id) pairs sorted by id
+        self.cell_image_ids = cell_image_ids
+        self.classes = classes
+
+    @property
+    def ids(self):
+        return self.cell_image_ids[:, 0]
+
+    @property
+    def image_ids(self):
+        return self.cell_image_ids[:, 1]
+
+    def __len__(self):
+        return len(self.cell_image_ids)
+
+    @property
+    def image_names(self):
+        return [im.name for im in self.images]
+
+
+def get_cell_selection(**kwargs):
     cases = kwargs.get('cases')
     classes = kwargs.get('classes')
     sample_size = kwargs.get('sample_size')
@@ -28,48 +83,64 @@ def get_image_and_cell_sets(**kwargs):
             print(f'Found {[im.name for im in images]}. Proceeding with found data.')
     else:
         images = Image.objects.all()
+    images = list(images.order_by('id'))
     cells = Cell.objects.filter(image__in=images)
-    cell_classes = cells.values_list('classification', flat=True).distinct()
+    cell_classes = None
     if classes is not None and len(classes):
-        cell_classes = [c for c in cell_classes if c in classes]
+        cell_classes = [c for c in get_cell_classes(images, cells) if c in classes]
         if not len(cell_classes):
             raise Exception('No cell classifications found matching classes list.')
-    cells = cells.filter(classification__in=cell_classes).all()
-    if sample_size:
+        cells = cells.filter(classification__in=cell_classes)
+    cells = cells.order_by('id')
+    sample_mode = kwargs.get('sample_mode') or 'first'
+    if sample_mode not in SAMPLE_MODES:
+        raise Exception(f'Unrecognized sample mode "{sample_mode}".')
+    if sample_size and sample_mode == 'first':
         cells = cells[:sample_size]
-    return (images, cells)
+    cell_image_ids = get_cell_image_ids(cells)
+    if sample_size and sample_mode != 'first' and sample_size < len(cell_image_ids):
+        seed = kwargs.get('seed')
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy % 2**32)
+        rng = np.random.default_rng(seed)
+        if sample_mode == 'random':
+            rows = np.sort(rng.choice(len(cell_image_ids), sample_size, replace=False))
+        else:
+            rows = sample_stratified(get_cell_strata(cell_image_ids), sample_size, rng)
+        print(f'Sampled {len(rows)} of {len(cell_image_ids)} cells ({sample_mode}, seed {seed}).')
+        cell_image_ids = cell_image_ids[rows]
+    return CellSelection(images, cell_image_ids, cell_classes)
 
 
-def parse_number(v):
-    try:
-        if v is None:
-            return None
-        if np.isnan(float(v)):
-            return None
-        return float(v)
-    except ValueError:
-        return v
-
-
-def get_umap_input_matrix(cells, columns):
-    column_indexes = {k: VECTOR_COLUMNS.index(k) for k in columns}
-    data = []
-    for cell in cells:
-        cell_vector = cell.vector
-        data.append({
-            k: parse_number(cell_vector[i]) for k, i in column_indexes.items()
-        })
-    df = pd.DataFrame(data, columns=columns)
-    # Drop non-numeric columns and fill NaNs
-    df = df.drop([
-        c for c in df.columns
-        if str(df[c].dtype) != 'float64'
-    ], axis=1).fillna(-1)
-    shape = df.shape
-    print(f'Generated DataFrame with {shape[0]} rows and {shape[1]} columns.')
-
-    input_data = normalize(df, axis=1, norm='l1')
-    return input_data
+def get_cell_strata(cell_image_ids):
+    # One stratum per (image, classification), from the classification codes of each SpatialIndex
+    strata = np.empty(len(cell_image_ids), dtype=np.int64)
+    offset = 0
+    for image_id in np.unique(cell_image_ids[:, 1]):
+        mask = cell_image_ids[:, 1] == image_id
+        index = get_spatial_index(int(image_id))
+        rows = np.searchsorted(index.ids(index.order), cell_image_ids[mask, 0])
+        strata[mask] = offset + index.codes(index.order)[rows]
+        offset += len(index.classes)
+    return strata
+
+
+def sample_stratified(strata, size, rng):
+    """
+    Rows of a random sample of the given size with each stratum represented in proportion
+    to its size; the rounding remainder goes to the strata with the largest fractions.
+    """
+    _, groups, counts = np.unique(strata, return_inverse=True, return_counts=True)
+    quotas = counts * size / len(strata)
+    allocation = np.floor(quotas).astype(np.int64)
+    remainder = size - allocation.sum()
+    allocation[np.argsort(allocation - quotas, kind='stable')[:remainder]] += 1
+    # Shuffle, then group by stratum and take the first rows allocated to each
+    order = rng.permutation(len(strata))
+    order = order[np.argsort(groups[order], kind='stable')]
+    starts = np.cumsum(counts) - counts
+    position = np.arange(len(order)) - starts[groups[order]]
+    return np.sort(order[position < allocation[groups[order]]])
 
 
 def fit_and_create_transform(**kwargs):
@@ -78,7 +149,7 @@ def fit_and_create_transform(**kwargs):
     name = kwargs.get('name')
     column_patterns = kwargs.get('column_patterns')
     umap_kwargs = kwargs.get('umap_kwargs')
-    images, cells = get_image_and_cell_sets(**kwargs)
+    selection = get_cell_selection(**kwargs)
     if column_patterns is not None and len(column_patterns):
         columns = [
             c for c in VECTOR_COLUMNS
@@ -96,40 +167,88 @@ def fit_and_create_transform(**kwargs):
         umap_kwarg_set.update(umap_kwargs)
     if not name:
         name = (
-            f'Transform of {len(cells)} cells' +
-            ' in ' + ', '.join([im.name for im in images]) +
+            f'Transform of {len(selection)} cells' +
+            ' in ' + ', '.join(selection.image_names) +
             f' ({len(columns)} columns)'
         )
 
     print('Generating data structure to fit UMAP Transform.')
-    input_data = get_umap_input_matrix(cells, columns)
+    input_data = get_umap_input_matrix(selection, columns)
 
     print('Fitting UMAP Transform.')
     transform = umap.UMAP(**umap_kwarg_set).fit(input_data)
 
-    print('Pickling UMAP Transform to save to database.')
-    content_file = None
-    content_file_name = 'transform.pkl'
-    with tempfile.TemporaryDirectory() as tmp:
-        filepath = Path(tmp) / content_file_name
-        with open(filepath, 'wb') as f:
-            pickle.dump(transform, f)
-        with open(filepath, 'rb') as f:
-            content_file = ContentFile(f.read(), content_file_name)
-
     print('Creating UMAPTransform object.')
     instance = UMAPTransform.objects.create(
         name=name,
         column_names=columns,
         umap_kwargs=umap_kwarg_set,
+        fitted_ids=encode_id_runs(selection.ids),
     )
-    instance.fitted_cells.set(cells)
-    instance.pickled.save(content_file_name, content_file)
+
+    print('Saving UMAP Transform.')
+    instance.pickled.name = save_transform(transform, instance.id)
+    instance.save(update_fields=['pickled'])
 
     seconds = (datetime.now() - start).total_seconds()
     print(f'Completed in {seconds} seconds.')
 
 
+# State shared with forked apply workers: the loaded transform and the input source
+_apply_state = {}
+
+
+def transform_chunk(bounds):
+    start, stop = bounds
+    cached = _apply_state['cached']
+    if cached is not None:
+        input_data = np.asarray(cached[start:stop])
+    else:
+        input_data = build_umap_input_matrix(
+            _apply_state['cell_image_ids'][start:stop], _apply_state['columns']
+        )
+    return start, _apply_state['transform'].transform(input_data)
+
+
+def apply_transform_in_chunks(transform, selection, columns, workers, chunk_size):
+    """
+    Embed the cells of a CellSelection in chunks of chunk_size cells, so only the input
+    of the chunks in progress is held in memory. With several workers, chunks are
+    transformed in forked processes that share the transform loaded here.
+    Inputs come from a cached input matrix when there is one, else from the FeatureStores.
+    """
+    numeric_columns = get_numeric_columns(columns)
+    cache_file = get_input_cache_file(selection, numeric_columns)
+    _apply_state.update(
+        transform=transform,
+        cell_image_ids=selection.cell_image_ids,
+        columns=numeric_columns,
+        cached=np.load(cache_file, mmap_mode='r') if cache_file.exists() else None,
+    )
+    total = len(selection)
+    chunks = [(start, min(start + chunk_size, total)) for start in range(0, total, chunk_size)]
+    output_data = np.empty((total, 2), dtype=np.float32)
+    done = 0
+    print(f'Applying transform to {total} cells in {len(chunks)} chunks with {workers} workers.')
+    parallel = workers > 1 and len(chunks) > 1
+    if parallel:
+        # Forked workers must not share the database connection
+        connections.close_all()
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) if parallel else nullcontext() as pool:
+            if parallel:
+                results = pool.imap_unordered(transform_chunk, chunks)
+            else:
+                results = map(transform_chunk, chunks)
+            for start, embedding in results:
+                output_data[start:start + len(embedding)] = embedding
+                done += len(embedding)
+                print(f'Transformed {done} of {total} cells.')
+    finally:
+        _apply_state.clear()
+    return output_data
+
+
 def create_transform_result(**kwargs):
     start = datetime.now()
 
@@ -138,26 +257,44 @@ def create_transform_result(**kwargs):
     if transform_id is None:
         raise Exception('UMAPTransform ID required.')
     transform_instance = UMAPTransform.objects.get(id=transform_id)
-    with open(transform_instance.pickled.path, "rb") as f:
-        transform = pickle.load(f)
+    transform = load_transform(transform_instance)
 
     print('Generating data structure to apply UMAP Transform.')
-    images, cells = get_image_and_cell_sets(**kwargs)
-    input_data = get_umap_input_matrix(cells, transform_instance.column_names)
-
-    print(f'Applying transform to {len(cells)} cells.')
-    output_data = transform.transform(input_data)
-    df = pd.DataFrame(output_data, columns=['x', 'y'])
+    selection = get_cell_selection(**kwargs)
+    output_data = apply_transform_in_chunks(
+        transform, selection, transform_instance.column_names,
+        kwargs.get('workers') or 1, kwargs.get('chunk_size') or APPLY_CHUNK_SIZE,
+    )
     # normalize
-    df = (df - df.min()) / (df.max() - df.min())
-    df['id'] = [cell.id for cell in cells]
+    low, high = output_data.min(axis=0), output_data.max(axis=0)
+    output_data = (output_data - low) / (high - low)
 
-    print('Creating UMAPResult object.')
-    instance = UMAPResult.objects.create(
-        transform=transform_instance,
-        scatterplot_data=df.to_json(orient='records')
-    )
-    instance.transformed_cells.set(cells)
+    # Points and tiles are written under a staging name before the UMAPResult exists, so that
+    # the database is not locked while they are built, and moved into place as it is created;
+    # the result is only committed, and listed, together with its files
+    staged = ResultPoints(f'new-{os.getpid()}')
+    instance = None
+    try:
+        save_result_points(staged.result_id, selection.ids, output_data[:, 0], output_data[:, 1])
+        print('Building density tiles.')
+        build_result_tiles(staged.result_id, selection.image_ids)
+
+        print('Creating UMAPResult object.')
+        with transaction.atomic():
+            instance = UMAPResult.objects.create(
+                transform=transform_instance,
+                cell_count=len(selection),
+                transformed_ids=encode_id_runs(selection.ids),
+            )
+            # Files of an earlier result with the same id that was rolled back
+            ResultPoints(instance.id).delete()
+            staged.folder.rename(ResultPoints(instance.id).folder)
+    except BaseException:
+        staged.delete()
+        if instance is not None:
+            # Rolled back after the files were moved
+            ResultPoints(instance.id).delete()
+        raise
 
     seconds = (datetime.now() - start).total_seconds()
     print(f'Completed in {seconds} seconds.')
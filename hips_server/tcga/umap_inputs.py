@@ -0,0 +1,81 @@
+import json
+import hashlib
+import numpy as np
+
+from sklearn.preprocessing import normalize
+
+from tcga.constants import CATEGORICAL_COLUMNS, UMAP_INPUTS_FOLDER
+from tcga.feature_store import FeatureStore, IDS_FILE
+
+
+# Input matrices of UMAP transforms, built from the image FeatureStores.
+# Kept apart from tcga.umap so that reading inputs does not import umap-learn.
+
+# Number of most recently used input matrices kept in UMAP_INPUTS_FOLDER
+MAX_CACHED_INPUTS = 8
+
+
+def get_input_digest(cell_image_ids, columns):
+    # Identifies the cell set, the columns and the current feature files they are read from
+    digest = hashlib.sha256(cell_image_ids.tobytes())
+    digest.update(json.dumps(columns).encode())
+    for image_id in np.unique(cell_image_ids[:, 1]):
+        store = FeatureStore(int(image_id))
+        if not store.exists():
+            raise Exception(f'Image {image_id} has no cell features; run populate first.')
+        for path in [store.folder / IDS_FILE, *[store.column_path(c) for c in columns]]:
+            stat = path.stat()
+            digest.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()
+
+
+def prune_input_cache():
+    files = sorted(UMAP_INPUTS_FOLDER.glob('*.npy'), key=lambda f: f.stat().st_mtime, reverse=True)
+    for f in files[MAX_CACHED_INPUTS:]:
+        f.unlink(missing_ok=True)
+
+
+def get_numeric_columns(columns):
+    return [c for c in columns if c not in CATEGORICAL_COLUMNS]
+
+
+def get_input_cache_file(selection, numeric_columns):
+    return UMAP_INPUTS_FOLDER / f'{get_input_digest(selection.cell_image_ids, numeric_columns)}.npy'
+
+
+def build_umap_input_matrix(cell_image_ids, columns):
+    data = np.empty((len(cell_image_ids), len(columns)), dtype=np.float32)
+    for image_id in np.unique(cell_image_ids[:, 1]):
+        mask = cell_image_ids[:, 1] == image_id
+        store = FeatureStore(int(image_id))
+        rows = store.rows_for_ids(cell_image_ids[mask, 0])
+        data[mask] = store.matrix(columns, rows)
+    data[np.isnan(data)] = -1
+    return normalize(data, axis=1, norm='l1', copy=False)
+
+
+def get_umap_input_matrix(selection, columns):
+    """
+    Returns the l1-normalized feature matrix (float32) of the cells of a CellSelection,
+    read from the image FeatureStores. Non-numeric columns are left out; nulls become -1.
+    Matrices are cached in UMAP_INPUTS_FOLDER, so repeated runs over the same cells
+    and columns load the matrix instead of rebuilding it.
+    """
+    numeric_columns = get_numeric_columns(columns)
+    cell_image_ids = selection.cell_image_ids
+    cache_file = get_input_cache_file(selection, numeric_columns)
+    if cache_file.exists():
+        input_data = np.load(cache_file)
+        cache_file.touch()
+        print('Loaded cached matrix.')
+    else:
+        input_data = build_umap_input_matrix(cell_image_ids, numeric_columns)
+        UMAP_INPUTS_FOLDER.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix('.tmp')
+        with open(tmp_file, 'wb') as f:
+            np.save(f, input_data)
+        tmp_file.rename(cache_file)
+        prune_input_cache()
+    shape = input_data.shape
+    print(f'Generated matrix with {shape[0]} rows and {shape[1]} columns.')
+    return input_data
@@ -1,22 +1,39 @@
-import type { Cell } from './types'
+import type {
+  Cell, ColumnStats, Histogram, IdRuns, PackedColumn, PackedHeader, ScatterBin, ScatterPoint,
+} from './types'
 import { statusProgress, status } from './store'
 
 export const baseURL = 'http://localhost:8000/api'
 
-export async function cachedFetch(url: string, cacheName: string) {
-  const cache = await caches.open(cacheName)
+const cellFields = ['id', 'x', 'y', 'width', 'height', 'orientation', 'classification']
+const packedArrayTypes: Record<
+  PackedHeader['columns'][number]['dtype'],
+  new (buffer: ArrayBuffer, byteOffset: number, length: number) => PackedColumn['values']
+> = {
+  float64: Float64Array,
+  float32: Float32Array,
+  int32: Int32Array,
+}
+
+async function revalidate(url: string, cache: Cache) {
+  // Fetch a response, or reuse the cached one if the server answers that it has not changed
   const cachedResponse = await cache.match(url)
-  let data
-  if (cachedResponse) {
-    data = await cachedResponse.json()
+  const etag = cachedResponse?.headers.get('ETag')
+  const response = await fetch(url, etag ? { headers: { 'If-None-Match': etag } } : {})
+  if (cachedResponse && (response.status === 304 || (!etag && !response.ok))) {
+    return { response: cachedResponse, cached: true }
   }
-  else {
-    const response = await fetch(url)
+  return { response, cached: false }
+}
+
+export async function cachedFetch(url: string, cacheName: string) {
+  const cache = await caches.open(cacheName)
+  const { response, cached } = await revalidate(url, cache)
+  if (!cached && response.ok) {
     // Clone the response because a Response object can only be consumed once
     await cache.put(url, response.clone())
-    data = await response.json()
   }
-  return data
+  return await response.json()
 }
 
 export async function fetchImages() {
@@ -24,17 +41,87 @@ export async function fetchImages() {
   return (await fetch(url)).json()
 }
 
+async function readBuffer(response: Response, onProgress?: (fraction: number) => void) {
+  // Read a response body chunk by chunk to report progress, copying it into one buffer at the end
+  const total = parseInt(response.headers.get('Content-Length') || '0')
+  if (!response.body || !total) return response.arrayBuffer()
+  const chunks: Uint8Array[] = []
+  let loaded = 0
+  const reader = response.body.getReader()
+  while (true) {
+    const { done, value } = await reader.read()
+    if (done) break
+    chunks.push(value)
+    loaded += value.length
+    if (onProgress) onProgress(Math.min(loaded / total, 1))
+  }
+  const buffer = new Uint8Array(loaded)
+  let offset = 0
+  chunks.forEach((chunk) => {
+    buffer.set(chunk, offset)
+    offset += chunk.length
+  })
+  return buffer.buffer as ArrayBuffer
+}
+
+export async function cachedFetchBuffer(
+  url: string, cacheName: string, onProgress?: (fraction: number) => void,
+) {
+  const cache = await caches.open(cacheName)
+  const { response, cached } = await revalidate(url, cache)
+  if (cached) return readBuffer(response, onProgress)
+  if (!response.ok) throw new Error(`Request failed with status ${response.status}: ${url}`)
+  // Store a copy of the response while reading it
+  const stored = cache.put(url, response.clone())
+  const buffer = await readBuffer(response, onProgress)
+  await stored
+  return buffer
+}
+
+export function unpackColumns(buffer: ArrayBuffer) {
+  // Packed binary column format, see tcga/binary.py on the server
+  const headerLength = new DataView(buffer).getUint32(0, true)
+  const header: PackedHeader = JSON.parse(
+    new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)),
+  )
+  const columns: Record<string, PackedColumn> = {}
+  let offset = 4 + headerLength
+  header.columns.forEach(({ name, dtype, categories }) => {
+    // Typed arrays use the platform byte order, which is little-endian in all supported browsers
+    const values = new packedArrayTypes[dtype](buffer, offset, header.count)
+    columns[name] = { values, categories }
+    offset += values.byteLength
+    offset += (8 - offset % 8) % 8
+  })
+  return { header, count: header.count, names: header.columns.map(c => c.name), columns }
+}
+
+function packedValue(column: PackedColumn, index: number) {
+  const value = column.values[index]
+  if (column.categories) return value < 0 ? undefined : column.categories[value]
+  return isNaN(value) ? undefined : value
+}
+
 export async function fetchImageCells(imageId: number) {
   statusProgress.value = 0
-  const limit = 10000
-  let results: Cell[] = []
-  let total: number | undefined = undefined
-  while (!total || results.length < total) {
-    const url = `${baseURL}/images/${imageId}/cells?offset=${results.length}&limit=${limit}`
-    const response: { items: Cell[], count: number } = await cachedFetch(url, 'cell-data-cache')
-    if (!total) total = response.count
-    results = [...results, ...response.items]
-    statusProgress.value = results.length / total * 100
+  const url = `${baseURL}/images/${imageId}/cells/binary`
+  const buffer = await cachedFetchBuffer(url, 'cell-data-cache', (fraction) => {
+    statusProgress.value = fraction * 100
+  })
+  const { count, names, columns } = unpackColumns(buffer)
+  const vectorColumns = names.filter(name => !cellFields.includes(name)).map(name => columns[name])
+  const results: Cell[] = new Array(count)
+  for (let i = 0; i < count; i++) {
+    results[i] = {
+      id: columns.id.values[i],
+      x: columns.x.values[i],
+      y: columns.y.values[i],
+      width: columns.width.values[i],
+      height: columns.height.values[i],
+      orientation: columns.orientation.values[i],
+      classification: packedValue(columns.classification, i) ?? '',
+      vector: vectorColumns.map(column => packedValue(column, i)),
+    } as Cell
   }
   statusProgress.value = 100
   // wait for progress bar to render updates
@@ -45,6 +132,78 @@ export async function fetchImageCells(imageId: number) {
   return results
 }
 
+export async function fetchHistogram(
+  imageId: number,
+  options: {
+    attribute: string
+    buckets?: number
+    scale?: 'linear' | 'log'
+    bucket_ids?: boolean
+    cell_ids?: number[]
+    selection?: IdRuns
+    filters?: Record<string, (string | number)[]>
+  },
+): Promise<Histogram> {
+  const url = `${baseURL}/images/${imageId}/histogram`
+  const response = await fetch(url, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(options),
+  })
+  return response.json()
+}
+
+export function encodeIdRuns(ids: Set<number>): IdRuns {
+  // Run-length encoded ids, see tcga/id_runs.py on the server
+  const sorted = Float64Array.from(ids).sort()
+  const runs: number[] = []
+  let end = sorted[0]
+  for (let i = 0; i < sorted.length; i++) {
+    if (i > 0 && sorted[i] === end) {
+      runs[runs.length - 1] += 1
+    }
+    else {
+      runs.push(sorted[i] - end, 1)
+    }
+    end = sorted[i] + 1
+  }
+  return { base: sorted.length ? sorted[0] : 0, runs, count: sorted.length }
+}
+
+export function decodeIdRuns({ base, runs, count }: IdRuns) {
+  const ids: number[] = new Array(count)
+  let id = base
+  let index = 0
+  for (let i = 0; i < runs.length; i += 2) {
+    id += runs[i]
+    for (let j = 0; j < runs[i + 1]; j++) ids[index++] = id++
+  }
+  return ids
+}
+
+export async function fetchFilterMatchIds(
+  imageId: number,
+  filters: Record<string, (string | number)[]>,
+  selectedIds?: Set<number>,
+) {
+  const url = `${baseURL}/images/${imageId}/filter`
+  const response = await fetch(url, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      filters,
+      selection: selectedIds ? encodeIdRuns(selectedIds) : undefined,
+    }),
+  })
+  return decodeIdRuns(await response.json())
+}
+
+export async function fetchColumnStats(imageId: number) {
+  const url = `${baseURL}/images/${imageId}/columns/stats`
+  const stats: ColumnStats[] = await (await fetch(url)).json()
+  return Object.fromEntries(stats.map(column => [column.name, column]))
+}
+
 export async function fetchCellColumns() {
   const url = `${baseURL}/cells/columns`
   return await cachedFetch(url, 'cell-data-cache')
@@ -59,3 +218,33 @@ export async function fetchUMAPTransformResults(transformId: number) {
   const url = `${baseURL}/umap/transforms/${transformId}/results`
   return (await fetch(url)).json()
 }
+
+export async function fetchUMAPResultPoints(resultId: number, imageId: number) {
+  const url = `${baseURL}/umap/results/${resultId}/points?image_id=${imageId}`
+  const { count, columns } = unpackColumns(await (await fetch(url)).arrayBuffer())
+  const points: ScatterPoint[] = new Array(count)
+  for (let i = 0; i < count; i++) {
+    points[i] = { id: columns.id.values[i], x: columns.x.values[i], y: columns.y.values[i] }
+  }
+  return points
+}
+
+export async function fetchUMAPResultTile(
+  resultId: number, z: number, x: number, y: number, imageId: number,
+) {
+  // Points of one image inside a tile of the embedding, or density bins when there are too many
+  const url = `${baseURL}/umap/results/${resultId}/tiles/${z}/${x}/${y}?image_id=${imageId}`
+  const { header, count, columns } = unpackColumns(await (await fetch(url)).arrayBuffer())
+  if (header.level === 'bins') {
+    const bins: ScatterBin[] = new Array(count)
+    for (let i = 0; i < count; i++) {
+      bins[i] = { x: columns.x.values[i], y: columns.y.values[i], count: columns.count.values[i] }
+    }
+    return { level: header.level, binSize: header.bin_size as number, bins }
+  }
+  const points: ScatterPoint[] = new Array(count)
+  for (let i = 0; i < count; i++) {
+    points[i] = { id: columns.id.values[i], x: columns.x.values[i], y: columns.y.values[i] }
+  }
+  return { level: header.level, points }
+}
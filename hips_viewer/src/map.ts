@@ -5,7 +5,7 @@ import {
   colorBy, colormapName, colorLegend, cellColors,
   selectedCellIds, selectedColor, annotationLayer,
   annotationMode, annotationBoolean, lastAnnotation,
-  filterMatchCellIds,
+  filterMatchCellIds, columnStats,
 } from '@/store'
 import {
   selectCell, clusterFirstPointId,
@@ -131,16 +131,17 @@ export function updateColors() {
     return
   }
 
-  const values = [...new Set(cells.value.map(
-    (cell: any) => cell[colorBy.value],
-  ).map(
-    (v: any) => isNaN(parseFloat(v)) ? v : parseFloat(v),
-  ).filter((v: any) => v !== undefined))]
+  // The domain comes from the column statistics rather than a pass over all cells
+  const stats = columnStats.value?.[colorBy.value]
+  if (!stats) {
+    colorLegend.value.categories([])
+    return
+  }
 
   let getCellColor
   const colors = colormap.colors
-  if (values.every(v => typeof v === 'number')) {
-    const domain: [number, number] = [Math.min(...values), Math.max(...values)]
+  if (stats.kind === 'numeric') {
+    const domain: [number, number] = [stats.minimum ?? 0, stats.maximum ?? 0]
     const colorFunction = colormap.getNumericColorFunction(domain)
     getCellColor = (cell: any) => {
       const value = cell[colorBy.value]
@@ -156,7 +157,8 @@ export function updateColors() {
     }])
   }
   else {
-    const colorFunction = colormap.getStringColorFunction(values as string[])
+    const values = Object.keys(stats.categories)
+    const colorFunction = colormap.getStringColorFunction(values)
     getCellColor = (cell: any) => {
       const value = cell[colorBy.value]
       if (value === undefined) return { r: 0, g: 0, b: 0 }
@@ -3,7 +3,7 @@ import {
   resetCurrentFilters,
   resetFilterOptions,
 } from './utils'
-import type { FilterOption, UMAPTransform, UMAPResult } from './types'
+import type { ColumnStats, FilterOption, UMAPTransform, UMAPResult } from './types'
 import { updateColorFunctions, updateOpacityFunctions } from './map'
 
 // Store variables
@@ -17,6 +17,7 @@ export const statusProgress = ref(0)
 
 export const cells = ref()
 export const cellColumns = ref()
+export const columnStats = ref<Record<string, ColumnStats>>()
 export const cellVectorsProcessed = ref(false)
 export const cellColors = ref()
 export const clusterIds = ref<Record<number, number[]>>({})
@@ -51,7 +52,8 @@ export const histSelectedBars = ref<Set<number>>(new Set<number>())
 export const cellData = ref<null | {
   key: string
   color: Function
-  cellIds: Set<number>
+  // [first, last] runs of the cell ids in the bucket
+  idRanges: [number, number][]
   count: number
 }[]>(null)
 export const chartData = ref()
@@ -81,6 +83,7 @@ function resetStore() {
   statusProgress.value = 0
   cells.value = undefined
   cellColumns.value = undefined
+  columnStats.value = undefined
   cellVectorsProcessed.value = false
   cellColors.value = undefined
   clusterIds.value = {}
@@ -144,8 +147,11 @@ watch(cells, () => {
   histCellIds.value = new Set(cells.value?.map((c: any) => c.id))
 })
 
-watch([cells, cellColumns, cellVectorsProcessed], () => {
-  if (cells.value && cellColumns.value && !filterOptions.value && cellVectorsProcessed.value) {
+watch([cells, cellColumns, columnStats, cellVectorsProcessed], () => {
+  if (
+    cells.value && cellColumns.value && columnStats.value
+    && !filterOptions.value && cellVectorsProcessed.value
+  ) {
     resetFilterOptions()
     resetCurrentFilters()
   }
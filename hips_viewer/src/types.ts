@@ -12,8 +12,25 @@ export interface Cell {
   height: number
   orientation: number
   classification: string
-  vector?: (string | number)[]
-  [vector_column: string]: string | number | undefined | (string | number)[]
+  vector?: (string | number | undefined)[]
+  [vector_column: string]: string | number | undefined | (string | number | undefined)[]
+}
+
+export interface PackedHeader {
+  count: number
+  columns: {
+    name: string
+    dtype: 'float64' | 'float32' | 'int32'
+    categories?: string[]
+  }[]
+  // viewport and UMAP result tile responses
+  level?: 'cells' | 'points' | 'bins'
+  bin_size?: number
+}
+
+export interface PackedColumn {
+  values: Float64Array | Float32Array | Int32Array
+  categories?: string[]
 }
 
 export interface Thumbnail {
@@ -66,7 +83,8 @@ export interface UMAPResult {
   id: number
   created: string
   transform: number
-  scatterplot_data: ScatterPoint[]
+  // Points are fetched separately, see fetchUMAPResultPoints
+  cell_count: number
 }
 
 export interface ScatterPoint {
@@ -74,3 +92,43 @@ export interface ScatterPoint {
   x: number
   y: number
 }
+
+export interface ScatterBin {
+  // origin of the bin in the embedding
+  x: number
+  y: number
+  count: number
+}
+
+export interface Histogram {
+  attribute: string
+  count: number
+  kind: 'numeric' | 'categorical'
+  // categorical: one count per key; numeric: one count per bucket between consecutive edges
+  keys?: (string | number)[]
+  edges?: number[]
+  counts: number[]
+  null_count: number
+  // [first, last] runs of cell ids in each bucket
+  id_ranges?: [number, number][][]
+}
+
+export interface IdRuns {
+  // ids start at base; runs alternate the number of ids to skip and to take
+  base: number
+  runs: number[]
+  count: number
+}
+
+export interface ColumnStats {
+  name: string
+  kind: 'numeric' | 'categorical'
+  count: number
+  null_count: number
+  minimum: number | null
+  maximum: number | null
+  mean: number | null
+  std: number | null
+  quantiles: Record<string, number>
+  categories: Record<string, number>
+}
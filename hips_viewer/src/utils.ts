@@ -11,11 +11,13 @@ import {
   histNumBuckets,
   histAttribute,
   showHistogram,
-  histCellIds,
   status,
   statusProgress,
   cellVectorsProcessed,
+  currentImage,
+  columnStats,
 } from './store'
+import { encodeIdRuns, fetchFilterMatchIds, fetchHistogram } from './api'
 import type { Cell, FilterOption, Colormap, RGB } from './types'
 
 // from https://stackoverflow.com/questions/5623838/rgb-to-hex-and-hex-to-rgb
@@ -154,80 +156,43 @@ const defaultFilterAttrs = [
   'Shape.MinorMajorAxisRatio',
 ]
 
-export function resetFilterOptions() {
-  const classifications: Set<string> = new Set()
-  const vectorRanges: Record<string, Record<any, any>> = {}
-  for (const attr of defaultFilterAttrs) {
-    vectorRanges[attr] = { min: undefined, max: undefined }
+function getFilterOption(attr: string): FilterOption | undefined {
+  // Options come from the column statistics computed at ingest, not from a pass over all cells
+  const stats = columnStats.value?.[attr]
+  if (!stats) return undefined
+  if (stats.kind === 'categorical') {
+    return { label: attr, options: Object.keys(stats.categories) }
   }
-  cells.value.forEach((cell: Cell) => {
-    classifications.add(cell.classification)
-    defaultFilterAttrs.forEach((attr) => {
-      const cellValue = cell[attr]?.toString()
-      if (cellValue && /^(-|\+|\.|e|\d)+$/.test(cellValue)) {
-        const value = parseFloat(parseFloat(cellValue).toPrecision(2))
-        // @ts-ignore
-        const range = vectorRanges[attr]
-        if (range.min === undefined || range.min > value) range.min = value
-        if (range.max === undefined || range.max < value) range.max = value
-      }
-    })
-  })
-  filterOptions.value = [
-    { label: 'classification', options: [...classifications] },
-  ]
-  for (const key in vectorRanges) {
-    filterOptions.value.push({
-      label: key, range: vectorRanges[key] as FilterOption['range'],
-    })
+  if (stats.minimum === null || stats.maximum === null) return undefined
+  return {
+    label: attr,
+    range: {
+      min: parseFloat(stats.minimum.toPrecision(2)),
+      max: parseFloat(stats.maximum.toPrecision(2)),
+    },
   }
 }
 
-export function addFilterOption(attr: string) {
-  const allValues = cells.value.map((cell: Cell) => {
-    const cellValue = cell[attr]?.toString()
-    if (cellValue && /^(-|\+|\.|e|\d)+$/.test(cellValue)) {
-      return parseFloat(parseFloat(cellValue).toPrecision(2))
-    }
-    return cellValue
-  })
-  if (allValues.some((v: string | number) => typeof v === 'string')) {
-    const valueSet = [...new Set(allValues)] as string[]
-    filterOptions.value?.push({ label: attr, options: valueSet })
-    currentFilters.value[attr] = []
-  }
-  else {
-    const range = {
-      min: parseFloat(Math.min(...allValues).toPrecision(2)),
-      max: parseFloat(Math.max(...allValues).toPrecision(2)),
-    }
-    filterOptions.value?.push({ label: attr, range })
-    currentFilters.value[attr] = [range.min, range.max]
-  }
+export function resetFilterOptions() {
+  filterOptions.value = ['classification', ...defaultFilterAttrs].map(
+    attr => getFilterOption(attr),
+  ).filter(option => option !== undefined) as FilterOption[]
 }
 
-export function getFilterMatchIds(selectedOnly: boolean) {
-  return cells.value.filter((cell: Cell) => {
-    if (selectedOnly && !selectedCellIds.value.has(cell.id)) return false
-    for (const key in currentFilters.value) {
-      const filterValue = currentFilters.value[key]
-      const cellValue = cell[key]?.toString()
+export function addFilterOption(attr: string) {
+  const option = getFilterOption(attr)
+  if (!option) return
+  filterOptions.value?.push(option)
+  currentFilters.value[attr] = option.range ? [option.range.min, option.range.max] : []
+}
 
-      if (cellValue && /^(-|\+|\.|e|\d)+$/.test(cellValue)) {
-        const numericValue = parseFloat(parseFloat(cellValue).toPrecision(2))
-        if (filterValue.length === 2) {
-          const range = filterValue as [number, number]
-          if (numericValue < range[0] || numericValue > range[1]) {
-            return false
-          }
-        }
-      }
-      else if (cellValue && filterValue.length && !filterValue.includes(cellValue)) {
-        return false
-      }
-    }
-    return true
-  }).map((cell: Cell) => cell.id)
+export async function getFilterMatchIds(selectedOnly: boolean) {
+  // Filters are evaluated column-wise on the server
+  return fetchFilterMatchIds(
+    currentImage.value.id,
+    currentFilters.value,
+    selectedOnly ? selectedCellIds.value : undefined,
+  )
 }
 
 export function resetCurrentFilters() {
@@ -245,69 +210,44 @@ export function resetCurrentFilters() {
   }
 }
 
-export function cellDistribution() {
-  if (!(cells.value && histCellIds.value)) return []
-  const histCells = cells.value.filter((cell: any) => histCellIds.value.has(cell.id))
-
-  const values = [...new Set(cells.value.map(
-    (cell: any) => cell[histAttribute.value],
-  ).map(
-    (v: any) => isNaN(parseFloat(v)) ? v : parseFloat(v),
-  ).filter((v: any) => v !== undefined)),
-  ].filter((v: any) => typeof v === 'number' || typeof v === 'string')
-
-  const cellIds: Record<string | number, Set<number>> = {}
-  const counts: Record<string | number, number> = {}
-  histCells.forEach((cell: any) => {
-    const key = cell[histAttribute.value]
-    if (key !== undefined) {
-      counts[key] = (counts[key] ?? 0) + 1
-
-      if (!cellIds[key]) cellIds[key] = new Set<number>()
-      cellIds[key].add(cell.id)
-    }
+export async function fetchCellDistribution(cellIds?: Set<number>) {
+  // Bucket counts and ids are computed on the server, over all cells of the image or the given ones
+  const histogram = await fetchHistogram(currentImage.value.id, {
+    attribute: histAttribute.value,
+    buckets: histNumBuckets.value,
+    bucket_ids: true,
+    selection: cellIds ? encodeIdRuns(cellIds) : undefined,
   })
+  const idRanges = histogram.id_ranges ?? []
 
-  showHistogram.value = values.length > histNumBuckets.value
-
-  if (values.length < histNumBuckets.value || !values.every(v => typeof v === 'number')) {
-    return values.map(v => ({
-      key: `${v}`,
-      count: counts[v] ?? 0,
-      cellIds: cellIds[v],
+  if (histogram.keys) {
+    const keys = histogram.keys
+    showHistogram.value = false
+    return keys.map((key, i) => ({
+      key: `${key}`,
+      count: histogram.counts[i],
+      idRanges: idRanges[i] ?? [],
       color: (colormap: Colormap) => {
         if (!colormap) return '#000'
-        const colorFunction = colormap.getStringColorFunction(values as string[])
-        return rgbToHex(colorFunction(v as string))
+        const colorFunction = colormap.getStringColorFunction(keys as string[])
+        return rgbToHex(colorFunction(key as string))
       },
     }))
   }
 
-  const vmin = Math.min(...values)
-  const vmax = Math.max(...values)
-  const step = (vmax - vmin) / histNumBuckets.value
-
-  const bucketedCellIds: Record<string | number, Set<number>> = {}
-  const bucketedCounts: Record<string, number> = {}
-  const bucketedMin: Record<string, number> = {}
-  values.sort((a, b) => a - b).forEach((value) => {
-    const bucketIndex = Math.floor((value - vmin) / step)
-    const bucketKey = `${bucketIndex * step}`
-    bucketedCounts[bucketKey] = (bucketedCounts[bucketKey] ?? 0) + (counts[value] ?? 0)
-    bucketedMin[bucketKey] = Math.min(bucketedMin[bucketKey] ?? vmax, value)
-
-    if (!bucketedCellIds[bucketKey]) bucketedCellIds[bucketKey] = new Set<number>()
-    cellIds[value]?.forEach(id => bucketedCellIds[bucketKey].add(id))
-  })
-
-  return Object.keys(bucketedCounts).sort((a, b) => (parseFloat(a) - parseFloat(b))).map(v => ({
-    key: `${bucketedMin[v].toFixed(2)}`,
-    count: bucketedCounts[v],
-    cellIds: bucketedCellIds[v],
+  // Numeric buckets, labeled by their lower edge
+  const edges = histogram.edges ?? []
+  const vmin = edges[0]
+  const vmax = edges[edges.length - 1]
+  showHistogram.value = true
+  return histogram.counts.map((count, i) => ({
+    key: `${edges[i].toFixed(2)}`,
+    count,
+    idRanges: idRanges[i] ?? [],
     color: (colormap: Colormap) => {
       if (!colormap) return '#000'
       const colorFunction = colormap.getNumericColorFunction([vmin, vmax])
-      return rgbToHex(colorFunction(bucketedMin[v]))
+      return rgbToHex(colorFunction(edges[i]))
     },
   }))
 }